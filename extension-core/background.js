@@ -79,6 +79,10 @@ function sendPayload() {
             try {
                 const parsedData = JSON.parse(event.data);
                 console.log(`Received data for jobId ${jobId}:`, parsedData);
+                for (const data of Object.values(parsedData)) {
+                    // Lets content.js tell a provisional estimate whose final data never came
+                    if (data.provisional) data.received_at = Date.now();
+                }
                 chrome.storage.local.set(parsedData);
             } catch (error) {
                 console.error('Error parsing incoming data:', error);
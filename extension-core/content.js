@@ -1,4 +1,6 @@
 const BASE_URL = "http://localhost:80";
+// A provisional estimate older than this lost its job, so the title is requested again
+const PROVISIONAL_TTL = 10 * 60 * 1000;
 
 (async function() {
     console.log("Chrome extension 'Netflix Critic' activated");
@@ -134,6 +136,31 @@ class TitleCard {
         });
     }
 
+    get estimatedGoogleRating() {
+        // Only served when there's no Google users rating; unconfident estimates aren't shown
+        return this.#lookup().then((data) => {
+            return data && data.estimate_confident ? data.estimated_google_users_rating : null;
+        });
+    }
+
+    get provisional() {
+        // An estimate sent while the server is still looking up the rating
+        return this.#lookup().then((data) => Boolean(data && data.provisional));
+    }
+
+    onFinalData(callback) {
+        // Calls back once the data replacing a provisional estimate is stored
+        const key = this.netflixId.toString();
+        const listener = (changes, areaName) => {
+            if (areaName !== 'local' || !(key in changes)) return;
+            const data = changes[key].newValue;
+            if (!data || data.provisional) return;
+            chrome.storage.onChanged.removeListener(listener);
+            callback(data);
+        };
+        chrome.storage.onChanged.addListener(listener);
+    }
+
     async #lookup() {
         const key = this.netflixId.toString();
         const timeout = 120 * 1000;
@@ -144,6 +171,11 @@ class TitleCard {
             const cachedData = await chrome.storage.local.get(key);
             return Object.keys(cachedData).length > 0 ? cachedData[key] : null;
         };
+
+        // Helper function: Drop a provisional estimate whose final data never came
+        const isStale = (data) => {
+            return data.provisional && !(Date.now() - data.received_at < PROVISIONAL_TTL);
+        };
     
         // Helper function: Set up polling with timeout
         const pollForData = (resolve, reject) => {
@@ -169,7 +201,8 @@ class TitleCard {
     
         // Main execution
         const cachedData = await getCachedData();
-        if (cachedData) return cachedData; // Return immediately if data exists
+        if (cachedData && !isStale(cachedData)) return cachedData; // Return immediately if data exists
+        if (cachedData) await chrome.storage.local.remove(key);
     
         // Notify background script to fetch the data
         chrome.runtime.sendMessage({
@@ -206,6 +239,17 @@ function getColorForValue(value) {
 }
 
 
+function renderRating(ratingDiv, rating, estimate) {
+    if (!rating && estimate) {
+        ratingDiv.style.color = getColorForValue(estimate);
+        ratingDiv.innerHTML = `<p title="Estimated from IMDb and Rotten Tomatoes ratings">~${estimate}</p>`;
+        return;
+    }
+    ratingDiv.style.color = getColorForValue(rating);
+    ratingDiv.innerHTML = `<p>${rating || "N/A"}</p>`;
+}
+
+
 async function reloadDOM(){
     const exclusions = (
         // Exclude live/upcoming
@@ -246,10 +290,15 @@ async function reloadDOM(){
         ratingDiv.appendChild(ratingSpinnerDiv)
         title.divElement.appendChild(ratingDiv);
 
-        title.googleRating.then((rating) => {
+        Promise.all([title.googleRating, title.estimatedGoogleRating, title.provisional]).then(([rating, estimate, provisional]) => {
             ratingSpinnerDiv.remove();
-            ratingDiv.style.color = getColorForValue(rating);
-            ratingDiv.innerHTML = `<p>${rating || "N/A"}</p>`;
+            renderRating(ratingDiv, rating, estimate);
+            if (provisional) {
+                title.onFinalData((data) => {
+                    const finalEstimate = data.estimate_confident ? data.estimated_google_users_rating : null;
+                    renderRating(ratingDiv, data.google_users_rating, finalEstimate);
+                });
+            }
         });
         
     }
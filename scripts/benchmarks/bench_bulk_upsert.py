@@ -0,0 +1,99 @@
+"""
+Compares `BaseModel.bulk_insert_ignore_conflicts` against the COPY-based
+`BaseModel.bulk_upsert` at 1k/100k/1M rows of synthetic titles.
+
+Everything runs inside a transaction that is rolled back, so it's safe to point
+at the local database (see the POSTGRES_* environment variables in app.py).
+
+    uv run python scripts/benchmarks/bench_bulk_upsert.py --sizes 1000 100000 1000000
+"""
+
+import os
+import sys
+import time
+import argparse
+import itertools
+from pathlib import Path
+
+from sqlmodel import Session, create_engine
+
+THIS_DIR = Path(__file__).parent
+ROOT_DIR = THIS_DIR.parent.parent
+sys.path.append(str(ROOT_DIR / "webserver"))
+
+from models import Title  # noqa: E402
+
+POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
+POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
+POSTGRES_PORT = os.getenv("POSTGRES_PORT", 5432)
+POSTGRES_DB = os.getenv("POSTGRES_DB", "postgres")
+DATABASE_URL = f"postgresql+psycopg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+
+# Well clear of real Netflix IDs so synthetic rows never collide with real ones
+NETFLIX_ID_OFFSET = 9_000_000_000_000
+
+# Postgres caps the number of bind parameters per statement
+MAX_BIND_PARAMS = 65_535
+
+
+def make_titles(n: int, release_year: int) -> list[Title]:
+    return [
+        Title(
+            netflix_id=NETFLIX_ID_OFFSET + i,
+            title=f"Benchmark Title {i}",
+            content_type="movie",
+            release_year=release_year,
+            runtime=90,
+        )
+        for i in range(n)
+    ]
+
+
+def insert_ignore_conflicts(session: Session, titles: list[Title]):
+    # One statement for every row would blow past MAX_BIND_PARAMS past a few
+    # thousand rows, so the current method has to be fed in the largest chunks it accepts
+    n_params = len(Title.model_fields) - 1
+    for chunk in itertools.batched(titles, MAX_BIND_PARAMS // n_params):
+        session.exec(Title.bulk_insert_ignore_conflicts(list(chunk)))
+
+
+def bulk_upsert(session: Session, titles: list[Title]):
+    Title.bulk_upsert(session, titles)
+
+
+def timed(engine, fn, titles: list[Title], preload: list[Title] = None) -> float:
+    with Session(engine) as session:
+        try:
+            if preload:
+                Title.bulk_upsert(session, preload)
+            start = time.perf_counter()
+            fn(session, titles)
+            session.flush()
+            return time.perf_counter() - start
+        finally:
+            session.rollback()
+
+
+def main(args):
+    engine = create_engine(DATABASE_URL)
+    print(f"{'rows':>10} {'method':<32} {'insert (s)':>12} {'update (s)':>12}")
+    for n in args.sizes:
+        fresh = make_titles(n, release_year=2000)
+        refreshed = make_titles(n, release_year=2001)
+        for name, fn in [
+            ("bulk_insert_ignore_conflicts", insert_ignore_conflicts),
+            ("bulk_upsert", bulk_upsert),
+        ]:
+            insert_time = timed(engine, fn, fresh)
+            # For the current method the "update" is a no-op, which is the point
+            update_time = timed(engine, fn, refreshed, preload=fresh)
+            print(f"{n:>10} {name:<32} {insert_time:>12.3f} {update_time:>12.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000]
+    )
+    main(parser.parse_args())
@@ -0,0 +1,130 @@
+"""
+Latency percentiles of the /api/search queries (`search.search_titles`, i.e.
+without the in-process cache), for a mix of prefixes, whole words and typos
+drawn from the stored titles.
+
+With --synthetic N, N made-up titles are added first so the catalog is a
+realistic size. This happens inside a transaction that is rolled back, so it's
+safe to point at the local database. Apply scripts/migrations/005_title_search.sql
+first, since without its indexes every query is a sequential scan.
+
+    uv run python scripts/benchmarks/bench_search.py --synthetic 300000 --queries 2000
+"""
+
+import sys
+import time
+import random
+import argparse
+import statistics
+from pathlib import Path
+
+from sqlmodel import Session, create_engine
+from sqlalchemy import text
+
+THIS_DIR = Path(__file__).parent
+ROOT_DIR = THIS_DIR.parent.parent
+sys.path.append(str(ROOT_DIR / "webserver"))
+
+from models import Title  # noqa: E402
+from database import DATABASE_URL  # noqa: E402
+from search import (  # noqa: E402
+    SEARCH_MIN_TRIGRAM_QUERY,
+    SEARCH_DEFAULT_LIMIT,
+    search_titles,
+    normalize_query,
+)
+
+# Well clear of real Netflix IDs so synthetic rows never collide with real ones
+NETFLIX_ID_OFFSET = 9_000_000_000_000
+
+
+def make_titles(n: int, words: list[str], rng: random.Random) -> list[Title]:
+    return [
+        Title(
+            netflix_id=NETFLIX_ID_OFFSET + i,
+            title=" ".join(rng.choices(words, k=rng.randint(1, 5))).title(),
+            content_type=rng.choice(["movie", "tv series"]),
+            release_year=rng.randint(1950, 2025),
+        )
+        for i in range(n)
+    ]
+
+
+def make_queries(titles: list[str], n: int, rng: random.Random) -> list[str]:
+    queries = []
+    for _ in range(n):
+        title = rng.choice(titles).lower()
+        kind = rng.random()
+        if kind < 0.5:
+            # Someone typing: every prefix length is equally likely
+            queries.append(title[: rng.randint(1, max(1, len(title)))])
+        elif kind < 0.8:
+            queries.append(rng.choice(title.split() or [title]))
+        else:
+            # A typo: one character dropped
+            i = rng.randrange(len(title))
+            queries.append(title[:i] + title[i + 1 :])
+    return [query for query in queries if query.strip()]
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    engine = create_engine(DATABASE_URL)
+    with Session(engine) as session:
+        try:
+            titles = list(
+                session.exec(
+                    text("SELECT title FROM titles WHERE title IS NOT NULL")
+                ).scalars()
+            )
+            if args.synthetic:
+                words = sorted({word for title in titles for word in title.split()})
+                synthetic = make_titles(args.synthetic, words, rng)
+                Title.bulk_upsert(session, synthetic)
+                session.exec(text("ANALYZE titles"))
+                titles += [title.title for title in synthetic]
+
+            print(f"{len(titles)} titles")
+            queries = make_queries(titles, args.queries, rng)
+
+            # Warm the buffer cache and psycopg's prepared statements
+            for query in queries[: args.warmup]:
+                search_titles(session, query, SEARCH_DEFAULT_LIMIT)
+
+            timings = {"prefix": [], "trigram": []}
+            for query in queries:
+                start = time.perf_counter()
+                search_titles(session, query, SEARCH_DEFAULT_LIMIT)
+                elapsed = (time.perf_counter() - start) * 1000
+                prefix_only = len(normalize_query(query)) < SEARCH_MIN_TRIGRAM_QUERY
+                kind = "prefix" if prefix_only else "trigram"
+                timings[kind].append(elapsed)
+        finally:
+            session.rollback()
+
+    print(
+        f"{'queries':<20} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    )
+    for kind, values in [*timings.items(), ("all", sum(timings.values(), []))]:
+        if not values:
+            continue
+        values.sort()
+        print(
+            f"{kind:<20} {len(values):>6} {statistics.median(values):>8.2f} "
+            f"{percentile(values, 95):>8.2f} {percentile(values, 99):>8.2f} {values[-1]:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--synthetic", type=int, default=0, help="Made-up titles to add first"
+    )
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,93 @@
+"""
+Reports the on-disk size of `titles` (and `title_metadata`, once it exists) and
+times the queries behind the read endpoints. Run it before and after applying
+scripts/migrations/003_title_metadata.sql to compare.
+
+    uv run python scripts/benchmarks/bench_title_metadata.py --repeat 20
+"""
+
+import sys
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+import psycopg
+
+THIS_DIR = Path(__file__).parent
+ROOT_DIR = THIS_DIR.parent.parent
+sys.path.append(str(ROOT_DIR / "webserver"))
+
+from database import PSYCOPG_CONNINFO  # noqa: E402
+
+TABLES = ["titles", "title_metadata"]
+
+QUERIES = {
+    # GET /api/titles
+    "available_titles": """
+        SELECT titles.id, titles.netflix_id, titles.title, titles.content_type,
+            titles.release_year, titles.runtime,
+            jsonb_agg(jsonb_build_object('vendor', ratings.vendor, 'rating', ratings.rating))
+        FROM titles
+        JOIN availability ON titles.netflix_id = availability.netflix_id
+        JOIN ratings ON titles.netflix_id = ratings.netflix_id
+        WHERE availability.available
+        GROUP BY titles.id, titles.netflix_id, titles.title, titles.content_type,
+            titles.release_year, titles.runtime
+    """,
+    # A full scan, as done by anything filtering on an unindexed column
+    "seq_scan_titles": "SELECT count(*) FROM titles WHERE title ILIKE '%the%'",
+    # GET /api/title/{id}
+    "title_by_id": """
+        SELECT titles.id, titles.netflix_id, titles.title, ratings.rating
+        FROM titles
+        LEFT JOIN ratings
+            ON ratings.netflix_id = titles.netflix_id AND ratings.vendor = 'Google users'
+        WHERE titles.netflix_id = (SELECT netflix_id FROM titles LIMIT 1)
+    """,
+}
+
+
+def report_sizes(cursor):
+    print(f"{'table':<16} {'heap':>12} {'toast':>12} {'total':>12}")
+    for table in TABLES:
+        cursor.execute("SELECT to_regclass(%s)", (table,))
+        if cursor.fetchone()[0] is None:
+            continue
+        cursor.execute(
+            """
+            SELECT
+                pg_size_pretty(pg_relation_size(c.oid)),
+                pg_size_pretty(COALESCE(pg_total_relation_size(c.reltoastrelid), 0)),
+                pg_size_pretty(pg_total_relation_size(c.oid))
+            FROM pg_class c
+            WHERE c.oid = %s::regclass
+            """,
+            (table,),
+        )
+        heap, toast, total = cursor.fetchone()
+        print(f"{table:<16} {heap:>12} {toast:>12} {total:>12}")
+
+
+def report_timings(cursor, repeat: int):
+    print(f"\n{'query':<20} {'median (ms)':>12} {'p95 (ms)':>12}")
+    for name, sql in QUERIES.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cursor.execute(sql)
+            cursor.fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+        p95 = statistics.quantiles(timings, n=20)[-1] if repeat > 1 else timings[0]
+        print(f"{name:<20} {statistics.median(timings):>12.2f} {p95:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with psycopg.connect(PSYCOPG_CONNINFO, autocommit=True) as conn:
+        with conn.cursor() as cursor:
+            report_sizes(cursor)
+            report_timings(cursor, args.repeat)
@@ -3,3 +3,8 @@ set -e
 
 echo "\n************** Restoring database from file at /data/pg_dump/Fc/pg.dump... \n"
 pg_restore -d postgres /data/pg_dump/Fc/pg.dump
+
+for migration in /docker-entrypoint-initdb.d/migrations/*.sql; do
+    echo "\n************** Applying migration $migration... \n"
+    psql -v ON_ERROR_STOP=1 -d postgres -f "$migration"
+done
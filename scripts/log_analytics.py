@@ -0,0 +1,442 @@
+"""
+Request analytics over the webserver's JSON logs (see webserver/app_logger.py).
+
+Streams every log file given, including rotated (app.log.1, ...) and gzipped
+(app.log.2.gz) ones, in constant memory. It reports:
+- requests/second per user agent, average and peak
+- latency percentiles per route (from `res.elapsed_ms`, logged since it was added)
+- a breakdown of status codes per route
+- bursts of 403 responses
+
+Restrict the analysis to a time window with --since/--until.
+
+    uv run python scripts/log_analytics.py webserver/logs/app.log* --since "2024-12-01 18:00"
+
+Rather than `json.loads` every record, it picks out the few fields it needs by
+their position in the `indent=2` layout the formatter writes. Most lines are
+discarded with a single `startswith` check, which keeps it I/O bound. --jobs
+processes parse in parallel: uncompressed files are split into byte ranges of
+--chunk-mb, each starting at the first record that begins inside it, so a single
+multi-GB app.log is spread over every job too. Gzipped files can't be split.
+A 403 burst spanning two chunks is merged after the fact.
+"""
+
+import re
+import sys
+import gzip
+import json
+import math
+import argparse
+import multiprocessing
+from typing import Any, Iterator, Optional
+from pathlib import Path
+from datetime import datetime
+from collections import Counter, defaultdict
+
+# Numeric IDs and UUIDs in paths are collapsed so e.g. every /api/title/{id} is one route
+ROUTE_PATTERNS = [
+    (
+        re.compile(
+            r"/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(?=/|$)"
+        ),
+        "/{uuid}",
+    ),
+    (re.compile(r"/\d+(?=/|$)"), "/{id}"),
+]
+
+# Relative precision of the latency histogram buckets
+LATENCY_PRECISION = 0.02
+PERCENTILES = (50, 90, 95, 99)
+
+# Prefixes of the lines holding the fields we use, as laid out by CustomJSONFormatter.
+# Lines are read as bytes, which json.loads takes as they are
+TIME_PREFIX = b'  "time": '
+URL_PREFIX = b'    "url": '
+USER_AGENT_PREFIX = b'      "user-agent": '
+STATUS_PREFIX = b'    "status_code": '
+ELAPSED_PREFIX = b'    "elapsed_ms": '
+
+
+def normalize_route(path: str) -> str:
+    for pattern, replacement in ROUTE_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return path
+
+
+def parse_value(line: bytes, prefix: bytes) -> Any:
+    return json.loads(line[len(prefix) :].rstrip().rstrip(b","))
+
+
+class TimestampParser:
+    """`asctime` timestamps, parsed once per second since consecutive records mostly share it."""
+
+    def __init__(self):
+        self._second = None
+        self._epoch = 0.0
+
+    def __call__(self, asctime: str) -> float:
+        # e.g. "2024-12-01 18:03:12,345"
+        second, _, millis = asctime.partition(",")
+        if second != self._second:
+            self._second = second
+            self._epoch = datetime.strptime(second, "%Y-%m-%d %H:%M:%S").timestamp()
+        return self._epoch + (int(millis) / 1000 if millis else 0)
+
+
+def iter_requests(
+    path: Path, start: int = 0, end: Optional[int] = None
+) -> Iterator[tuple[float, str, str, int, Optional[float]]]:
+    """
+    Yields (timestamp, route, user agent, status code, elapsed ms) for every request
+    logged in `path` whose record starts at a byte offset in [start, end).
+    """
+    opener = gzip.open if path.suffix == ".gz" else open
+    parse_time = TimestampParser()
+
+    with opener(path, "rb") as f:
+        pos = start
+        if start:
+            # Skip the line straddling `start`, then whatever is left of the record
+            # it belongs to: the previous range finishes that one
+            f.seek(start - 1)
+            pos += len(f.readline()) - 1
+        in_record = False
+        asctime = url = user_agent = status = elapsed = None
+        for line in f:
+            line_start = pos
+            pos += len(line)
+            if line.startswith(b"{"):
+                # Start of a record
+                if end is not None and line_start >= end:
+                    return
+                in_record = True
+            elif not in_record:
+                continue
+            elif line.startswith(b"}"):
+                # End of a record
+                if status is not None and url is not None and asctime is not None:
+                    yield (
+                        parse_time(asctime),
+                        normalize_route(url),
+                        user_agent or "-",
+                        status,
+                        elapsed,
+                    )
+                in_record = False
+                asctime = url = user_agent = status = elapsed = None
+            elif not line.startswith(b"  "):
+                continue
+            elif line.startswith(TIME_PREFIX):
+                asctime = parse_value(line, TIME_PREFIX)
+            elif line.startswith(URL_PREFIX):
+                url = parse_value(line, URL_PREFIX)
+            elif line.startswith(USER_AGENT_PREFIX):
+                user_agent = parse_value(line, USER_AGENT_PREFIX)
+            elif line.startswith(STATUS_PREFIX):
+                status = parse_value(line, STATUS_PREFIX)
+            elif line.startswith(ELAPSED_PREFIX):
+                elapsed = parse_value(line, ELAPSED_PREFIX)
+
+
+class LatencyHistogram:
+    """Log-scale histogram: fixed memory, percentiles accurate to LATENCY_PRECISION."""
+
+    _log_base = math.log1p(LATENCY_PRECISION)
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+
+    def add(self, ms: float):
+        self.buckets[math.floor(math.log(max(ms, 0.001)) / self._log_base)] += 1
+        self.count += 1
+
+    def merge(self, other: "LatencyHistogram"):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return math.exp((bucket + 0.5) * self._log_base)
+
+
+class BurstDetector:
+    """Finds stretches where at least `threshold` matching responses land within `window` seconds of each other."""
+
+    def __init__(self, threshold: int, window: float):
+        self.threshold = threshold
+        self.window = window
+        self.bursts: list[list] = []  # [start, end, count]
+        self._recent: list[float] = []
+
+    def add(self, ts: float):
+        burst = self.bursts[-1] if self.bursts else None
+        if burst is not None and ts - burst[1] <= self.window:
+            burst[1] = max(burst[1], ts)
+            burst[2] += 1
+            return
+
+        # Only the last `threshold` timestamps matter, so this stays bounded
+        self._recent = [
+            t for t in self._recent[-(self.threshold - 1) :] if ts - t <= self.window
+        ]
+        self._recent.append(ts)
+        if len(self._recent) >= self.threshold:
+            self.bursts.append([self._recent[0], ts, len(self._recent)])
+            self._recent = []
+
+    def merge(self, other: "BurstDetector"):
+        self.bursts = sorted(self.bursts + other.bursts)
+        merged = []
+        for burst in self.bursts:
+            if merged and burst[0] - merged[-1][1] <= self.window:
+                merged[-1][1] = max(merged[-1][1], burst[1])
+                merged[-1][2] += burst[2]
+            else:
+                merged.append(list(burst))
+        self.bursts = merged
+
+
+class RequestStats:
+    def __init__(self, args):
+        self.since = args.since
+        self.until = args.until
+        self.bucket = args.bucket
+        self.requests = 0
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.by_user_agent = Counter()
+        # Peak rate per user agent, from per-bucket counts of (mostly) time-ordered records
+        self.peak_by_user_agent = Counter()
+        self._current_bucket: dict[str, tuple[int, int]] = {}
+        # The counts of the first bucket, for stitching together a bucket that's
+        # split between two byte ranges when their stats are merged
+        self._first_bucket: dict[str, tuple[int, int]] = {}
+        self.latency = defaultdict(LatencyHistogram)
+        self.statuses = defaultdict(Counter)
+        self.forbidden = BurstDetector(args.burst_threshold, args.burst_window)
+
+    def add(self, ts, route, user_agent, status, elapsed):
+        if (self.since and ts < self.since) or (self.until and ts >= self.until):
+            return
+
+        self.requests += 1
+        self.first = ts if self.first is None else min(self.first, ts)
+        self.last = ts if self.last is None else max(self.last, ts)
+
+        self.by_user_agent[user_agent] += 1
+        bucket = int(ts // self.bucket)
+        current, count = self._current_bucket.get(user_agent, (bucket, 0))
+        count = count + 1 if current == bucket else 1
+        self._current_bucket[user_agent] = (bucket, count)
+        first = self._first_bucket.setdefault(user_agent, (bucket, count))
+        if first == (bucket, count - 1):
+            self._first_bucket[user_agent] = (bucket, count)
+        if count > self.peak_by_user_agent[user_agent]:
+            self.peak_by_user_agent[user_agent] = count
+
+        if elapsed is not None:
+            self.latency[route].add(elapsed)
+        self.statuses[route][status] += 1
+        if status == 403:
+            self.forbidden.add(ts)
+
+    def merge(self, other: "RequestStats"):
+        """Adds the stats of `other`, which must cover the records right after these."""
+        self.requests += other.requests
+        for ts in (other.first, other.last):
+            if ts is not None:
+                self.first = ts if self.first is None else min(self.first, ts)
+                self.last = ts if self.last is None else max(self.last, ts)
+        self.by_user_agent.update(other.by_user_agent)
+        for user_agent, (bucket, count) in other._first_bucket.items():
+            current = self._current_bucket.get(user_agent)
+            if current is None:
+                self._first_bucket[user_agent] = (bucket, count)
+            elif current[0] == bucket:
+                stitched = (bucket, current[1] + count)
+                self.peak_by_user_agent[user_agent] = max(
+                    self.peak_by_user_agent[user_agent], stitched[1]
+                )
+                if self._first_bucket[user_agent] == current:
+                    self._first_bucket[user_agent] = stitched
+                if other._current_bucket[user_agent] == (bucket, count):
+                    self._current_bucket[user_agent] = stitched
+                    continue
+            self._current_bucket[user_agent] = other._current_bucket[user_agent]
+        for user_agent, peak in other.peak_by_user_agent.items():
+            self.peak_by_user_agent[user_agent] = max(
+                self.peak_by_user_agent[user_agent], peak
+            )
+        for route, histogram in other.latency.items():
+            self.latency[route].merge(histogram)
+        for route, statuses in other.statuses.items():
+            self.statuses[route].update(statuses)
+        self.forbidden.merge(other.forbidden)
+
+    def report(self) -> dict[str, Any]:
+        duration = max((self.last or 0) - (self.first or 0), 1)
+
+        def iso(ts):
+            return datetime.fromtimestamp(ts).isoformat(sep=" ") if ts else None
+
+        return {
+            "requests": self.requests,
+            "from": iso(self.first),
+            "to": iso(self.last),
+            "user_agents": {
+                user_agent: {
+                    "requests": count,
+                    "avg_rps": count / duration,
+                    "peak_rps": self.peak_by_user_agent[user_agent] / self.bucket,
+                }
+                for user_agent, count in self.by_user_agent.most_common()
+            },
+            "latency_ms": {
+                route: {
+                    "count": histogram.count,
+                    **{f"p{p}": histogram.percentile(p) for p in PERCENTILES},
+                }
+                for route, histogram in sorted(self.latency.items())
+            },
+            "status_codes": {
+                route: dict(sorted(statuses.items()))
+                for route, statuses in sorted(self.statuses.items())
+            },
+            "forbidden_bursts": [
+                {"start": iso(start), "end": iso(end), "count": count}
+                for start, end, count in self.forbidden.bursts
+            ],
+        }
+
+
+def analyze(path: Path, start: int, end: Optional[int], args) -> RequestStats:
+    stats = RequestStats(args)
+    for request in iter_requests(path, start, end):
+        stats.add(*request)
+    return stats
+
+
+def split_into_ranges(
+    path: Path, chunk_bytes: int
+) -> list[tuple[Path, int, Optional[int]]]:
+    if path.suffix == ".gz":
+        return [(path, 0, None)]
+    size = path.stat().st_size
+    starts = range(0, max(size, 1), chunk_bytes)
+    return [(path, start, start + chunk_bytes) for start in starts]
+
+
+def rotation_order(path: Path) -> tuple[str, int]:
+    # app.log.3.gz, app.log.2, app.log.1, app.log: oldest first
+    name = path.name.removesuffix(".gz")
+    base, _, index = name.rpartition(".")
+    if index.isdigit():
+        return base, -int(index)
+    return name, 0
+
+
+def print_report(report: dict[str, Any]):
+    print(f"{report['requests']} requests from {report['from']} to {report['to']}\n")
+
+    print(f"{'user agent':<60} {'requests':>10} {'avg rps':>9} {'peak rps':>9}")
+    for user_agent, row in report["user_agents"].items():
+        print(
+            f"{user_agent[:60]:<60} {row['requests']:>10} {row['avg_rps']:>9.2f} {row['peak_rps']:>9.2f}"
+        )
+
+    print(
+        f"\n{'route':<40} {'count':>8}"
+        + "".join(f"{f'p{p} ms':>10}" for p in PERCENTILES)
+    )
+    for route, row in report["latency_ms"].items():
+        print(
+            f"{route[:40]:<40} {row['count']:>8}"
+            + "".join(f"{row[f'p{p}']:>10.1f}" for p in PERCENTILES)
+        )
+
+    print(f"\n{'route':<40} status codes")
+    for route, statuses in report["status_codes"].items():
+        print(
+            f"{route[:40]:<40} " + ", ".join(f"{k}: {v}" for k, v in statuses.items())
+        )
+
+    print(f"\n{len(report['forbidden_bursts'])} bursts of 403s")
+    for burst in report["forbidden_bursts"]:
+        print(f"  {burst['start']} - {burst['end']}: {burst['count']}")
+
+
+def parse_datetime(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+
+def main(args):
+    paths = sorted(args.logs, key=rotation_order)
+    chunk_bytes = int(args.chunk_mb * 1024 * 1024)
+    ranges = [
+        byte_range
+        for path in paths
+        for byte_range in split_into_ranges(path, chunk_bytes)
+    ]
+    with multiprocessing.Pool(args.jobs) as pool:
+        results = pool.starmap(analyze, [(*byte_range, args) for byte_range in ranges])
+
+    stats = RequestStats(args)
+    for result in results:
+        stats.merge(result)
+
+    report = stats.report()
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("logs", type=Path, nargs="+", help="Log files, rotated or not")
+    parser.add_argument(
+        "--since",
+        type=parse_datetime,
+        help="Only count requests at or after this (local time)",
+    )
+    parser.add_argument(
+        "--until",
+        type=parse_datetime,
+        help="Only count requests before this (local time)",
+    )
+    parser.add_argument(
+        "--bucket",
+        type=float,
+        default=1,
+        help="Seconds over which peak rps is measured",
+    )
+    parser.add_argument(
+        "--burst-threshold", type=int, default=10, help="403s that make up a burst"
+    )
+    parser.add_argument(
+        "--burst-window",
+        type=float,
+        default=60,
+        help="Seconds within which --burst-threshold 403s must fall",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Files (or parts of files) parsed in parallel (default: CPUs)",
+    )
+    parser.add_argument(
+        "--chunk-mb",
+        type=float,
+        default=64,
+        help="Size of the byte ranges uncompressed files are split into",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    main(parser.parse_args())
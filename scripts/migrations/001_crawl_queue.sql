@@ -0,0 +1,18 @@
+-- Work queue for the background re-crawl workers (see webserver/worker.py).
+-- Rows are claimed with FOR UPDATE SKIP LOCKED and leased until `leased_until`
+-- so any number of worker processes can share the queue.
+CREATE TABLE IF NOT EXISTS crawl_queue (
+    id                serial PRIMARY KEY,
+    netflix_id        bigint NOT NULL,
+    country           char(2) NOT NULL,
+    request_count     integer NOT NULL DEFAULT 0,
+    last_requested_at timestamp,
+    last_crawled_at   timestamp,
+    leased_until      timestamp,
+    attempts          smallint NOT NULL DEFAULT 0,
+    last_error        text,
+    CONSTRAINT crawl_queue_unique_country_and_netflix_id UNIQUE (country, netflix_id)
+);
+
+CREATE INDEX IF NOT EXISTS crawl_queue_last_crawled_at_idx
+    ON crawl_queue (last_crawled_at NULLS FIRST);
@@ -0,0 +1,23 @@
+-- Job state shared by every webserver worker (see webserver/job_state.py).
+-- Results are published to `job_results` and announced with NOTIFY job_results
+-- so whichever worker serves /api/stream/{job_id} can relay them.
+CREATE TABLE IF NOT EXISTS jobs (
+    id           uuid PRIMARY KEY,
+    country      char(2) NOT NULL,
+    payload      bigint[] NOT NULL,
+    status       varchar(16) NOT NULL DEFAULT 'pending',
+    owner        text,
+    heartbeat_at timestamp,
+    created_at   timestamp NOT NULL DEFAULT now(),
+    finished_at  timestamp
+);
+
+CREATE INDEX IF NOT EXISTS jobs_created_at_idx ON jobs (created_at);
+
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id  uuid NOT NULL,
+    seq     integer NOT NULL,
+    message text NOT NULL,
+    CONSTRAINT job_results_pkey PRIMARY KEY (job_id, seq),
+    CONSTRAINT job_results_job_id_fkey FOREIGN KEY (job_id) REFERENCES jobs (id) ON DELETE CASCADE
+);
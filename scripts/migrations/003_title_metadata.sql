@@ -0,0 +1,34 @@
+-- Moves the react context blob out of `titles` into `title_metadata`, so scans and
+-- joins of `titles` by the read endpoints no longer drag it along. The blob is
+-- lz4-compressed (PostgreSQL 14+) when it's large enough to be TOASTed.
+-- Measure before/after with scripts/benchmarks/bench_title_metadata.py.
+CREATE TABLE IF NOT EXISTS title_metadata (
+    id            serial PRIMARY KEY,
+    netflix_id    bigint NOT NULL,
+    react_context jsonb,
+    CONSTRAINT title_metadata_netflix_id_key UNIQUE (netflix_id),
+    CONSTRAINT title_metadata_netflix_id_fkey FOREIGN KEY (netflix_id) REFERENCES titles (netflix_id) ON DELETE CASCADE
+);
+
+ALTER TABLE title_metadata ALTER COLUMN react_context SET COMPRESSION lz4;
+
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'titles' AND column_name = 'metadata'
+    ) THEN
+        INSERT INTO title_metadata (netflix_id, react_context)
+        SELECT netflix_id, metadata
+        FROM titles
+        WHERE metadata IS NOT NULL AND metadata <> '[]'::jsonb
+        ON CONFLICT (netflix_id) DO NOTHING;
+
+        ALTER TABLE titles DROP COLUMN metadata;
+    END IF;
+END
+$$;
+
+-- Dropping a column doesn't shrink the heap; rewrite it
+VACUUM FULL titles;
+ANALYZE titles, title_metadata;
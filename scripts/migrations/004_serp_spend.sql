@@ -0,0 +1,12 @@
+-- Daily Bright Data SERP request counts shared by every process (see webserver/budget.py),
+-- plus how many requests the per-job and per-day caps blocked.
+CREATE TABLE IF NOT EXISTS serp_spend (
+    day                date PRIMARY KEY,
+    requests           integer NOT NULL DEFAULT 0,
+    blocked_by_job_cap integer NOT NULL DEFAULT 0,
+    blocked_by_day_cap integer NOT NULL DEFAULT 0
+);
+
+-- Per-job spend, reported when a streaming job finishes
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS serp_requests integer NOT NULL DEFAULT 0;
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS serp_blocked integer NOT NULL DEFAULT 0;
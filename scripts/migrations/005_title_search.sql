@@ -0,0 +1,10 @@
+-- Indexes behind /api/search (see webserver/search.py):
+-- a trigram GIN index for fuzzy word matches, and a btree for short prefix matches,
+-- which trigrams can't serve. Measure with scripts/benchmarks/bench_search.py.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS titles_title_trgm_idx
+    ON titles USING gin (title gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS titles_title_lower_prefix_idx
+    ON titles (lower(title) text_pattern_ops);
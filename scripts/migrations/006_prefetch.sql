@@ -0,0 +1,20 @@
+-- Predictive prefetching of related titles (see webserver/prefetch.py).
+-- Titles the prefetcher queues are marked with how many hops they are from a
+-- title a user actually asked for, and are only crawled when workers are otherwise idle.
+ALTER TABLE crawl_queue ADD COLUMN IF NOT EXISTS prefetch_depth smallint;
+ALTER TABLE crawl_queue ADD COLUMN IF NOT EXISTS prefetched_at timestamp;
+-- First time a user asked for the title after it was prefetched
+ALTER TABLE crawl_queue ADD COLUMN IF NOT EXISTS prefetch_hit_at timestamp;
+
+CREATE INDEX IF NOT EXISTS crawl_queue_pending_prefetch_idx
+    ON crawl_queue (prefetch_depth, id)
+    WHERE prefetch_depth IS NOT NULL AND prefetched_at IS NULL;
+
+-- Daily prefetch counters shared by every process
+CREATE TABLE IF NOT EXISTS prefetch_stats (
+    day      date PRIMARY KEY,
+    enqueued integer NOT NULL DEFAULT 0,
+    fetched  integer NOT NULL DEFAULT 0,
+    requests integer NOT NULL DEFAULT 0,
+    hits     integer NOT NULL DEFAULT 0
+);
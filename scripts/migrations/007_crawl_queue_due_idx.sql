@@ -0,0 +1,6 @@
+-- Lets refresh claims (see claim_due in webserver/crawl_queue.py) read the stalest
+-- due rows in index order instead of ranking the whole queue. Titles the
+-- prefetcher hasn't crawled yet are left out, since refresh claims skip them.
+CREATE INDEX IF NOT EXISTS crawl_queue_due_idx
+    ON crawl_queue (last_crawled_at NULLS FIRST)
+    WHERE NOT (prefetch_depth IS NOT NULL AND prefetched_at IS NULL);
@@ -4,6 +4,7 @@ It was useful for validating a request rate limiting implementation as well as
 checking the number of requests/second aiohttp was capable of making.
 Have a look at the assets/ dir for the visual.
 Mostly copy-pasted from ChatGPT.
+For anything beyond the last minute of a small log, use scripts/log_analytics.py instead.
 """
 
 import json
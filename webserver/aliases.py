@@ -0,0 +1,64 @@
+import re
+import threading
+from typing import Optional
+
+from sqlmodel import Session
+from sqlalchemy import text
+
+NETFLIX_ID_IN_PATH = re.compile(r"/title/(\d+)")
+
+
+def parse_netflix_id(url_or_path: Optional[str]) -> Optional[int]:
+    """Extracts the title ID from e.g. `https://www.netflix.com/title/80057281`."""
+    if not url_or_path:
+        return None
+    match = NETFLIX_ID_IN_PATH.search(url_or_path)
+    return int(match.group(1)) if match else None
+
+
+class AliasIndex:
+    """
+    In-memory map of Netflix IDs that redirect to another (canonical) title,
+    built from `availability.redirected_netflix_id`. Redirects are per country.
+    """
+
+    # Redirects can chain; anything longer than this is treated as a cycle
+    MAX_HOPS = 8
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._aliases: dict[tuple[int, str], int] = {}
+
+    def __len__(self) -> int:
+        return len(self._aliases)
+
+    def load(self, session: Session):
+        rows = session.exec(
+            text(
+                """
+                SELECT netflix_id, country, redirected_netflix_id
+                FROM availability
+                WHERE redirected_netflix_id IS NOT NULL
+                    AND redirected_netflix_id <> netflix_id
+                """
+            )
+        ).all()
+        aliases = {(alias, country): canonical for alias, country, canonical in rows}
+        with self._lock:
+            self._aliases = aliases
+
+    def add(self, alias: int, canonical: int, country: str):
+        if alias != canonical:
+            with self._lock:
+                self._aliases[(alias, country)] = canonical
+
+    def resolve(self, netflix_id: int, country: str) -> int:
+        """Follows redirects to the canonical ID; IDs that aren't aliases map to themselves."""
+        aliases = self._aliases
+        resolved = netflix_id
+        for _ in range(self.MAX_HOPS):
+            canonical = aliases.get((resolved, country))
+            if canonical is None:
+                return resolved
+            resolved = canonical
+        return netflix_id
@@ -1,31 +1,64 @@
 import os
 import json
+import time
 import asyncio
-import itertools
+import functools
 from http import HTTPStatus
-from uuid import uuid4
-from typing import Any, Dict, Optional, Annotated
+from uuid import UUID
+from typing import Dict, Optional, Annotated
 from pathlib import Path
-from collections import defaultdict
+from contextlib import aclosing, asynccontextmanager
 
-import aiohttp
+import anyio
 import app_logger
 from common import (
-    JobStore,
-    HTMLContent,
     NetflixSessionHandler,
-    ContextExtractionError,
     BrightDataSessionHandler,
-    get_field,
-    get_serp_html,
     configure_logger,
-    save_response_body,
-    extract_netflix_react_context,
 )
-from models import Title, Rating, Availability
+from models import Job, Title, Rating, Availability
+from database import PSYCOPG_CONNINFO, engine, DatabaseSessionDep
+from pipeline import (
+    DOWNLOADED_TITLEPAGES_DIR,
+    RecordBuffer,
+    build_title_pipeline,
+    shutdown_parse_executor,
+)
+from job_state import JOB_HEARTBEAT_SECONDS, PostgresJobStore
+from crawl_queue import RequestCounter, enqueue_titles, recently_crawled
+from prefetch import (
+    enqueue_related,
+    record_requests,
+    related_title_ids,
+    get_prefetch_stats,
+)
+from budget import SerpBudget, get_spend_today
+from cache import TTLCache, TitleCache
+from aliases import AliasIndex
+from snapshot import IDENTITY, SnapshotCache
+from stages import pipeline_metrics
+from search import (
+    SEARCH_MAX_LIMIT,
+    SEARCH_DEFAULT_LIMIT,
+    SEARCH_MIN_TRIGRAM_QUERY,
+    search_titles,
+    normalize_query,
+)
+from estimates import (
+    TARGET_VENDOR,
+    ESTIMATE_SKIP_SERP,
+    ESTIMATE_REFIT_SECONDS,
+    rating_estimator,
+    load_vendor_ratings,
+)
+from profiling import (
+    AdminDep,
+    LoopLagMonitor,
+    ProfilingMiddleware,
+    profile_store,
+)
 from fastapi import (
     Query,
-    Depends,
     FastAPI,
     Request,
     Response,
@@ -33,7 +66,7 @@ from fastapi import (
     BackgroundTasks,
 )
 from pydantic import BaseModel
-from sqlmodel import Session, select, create_engine
+from sqlmodel import Session, select
 from sqlalchemy import func
 from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
@@ -42,24 +75,100 @@ from starlette.background import BackgroundTask
 from starlette.middleware.cors import CORSMiddleware
 
 THIS_DIR = Path(__file__).parent
-ROOT_DIR = THIS_DIR.parent
-DOWNLOADED_TITLEPAGES_DIR = ROOT_DIR / "data" / "raw" / "title"  # TODO
-DOWNLOADED_SERP_PAGES_DIR = ROOT_DIR / "data" / "raw" / "serp"  # TODO
 
 STATUS_REASONS = {x.value: x.name for x in list(HTTPStatus)}
 
-POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
-POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "")
-POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
-POSTGRES_PORT = os.getenv("POSTGRES_PORT", 5432)
-POSTGRES_DB = os.getenv("POSTGRES_DB", "postgres")
-DATABASE_URL = f"postgresql+psycopg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# How often title lookup counts are flushed to the crawl queue
+REQUEST_COUNT_FLUSH_SECONDS = float(os.getenv("REQUEST_COUNT_FLUSH_SECONDS", 30))
+
+# How often finished jobs past their retention are deleted
+JOB_PRUNE_SECONDS = float(os.getenv("JOB_PRUNE_SECONDS", 3600))
+
+# Bounds for the in-process cache of /api/title lookups. Other workers' writes only
+# become visible once an entry expires, hence the short TTLs
+TITLE_CACHE_MAXSIZE = int(os.getenv("TITLE_CACHE_MAXSIZE", 100_000))
+TITLE_CACHE_TTL_SECONDS = float(os.getenv("TITLE_CACHE_TTL_SECONDS", 300))
+TITLE_CACHE_NEGATIVE_TTL_SECONDS = float(
+    os.getenv("TITLE_CACHE_NEGATIVE_TTL_SECONDS", 60)
+)
+
+# Upper bound on how stale the /api/titles snapshot gets when another process wrote the data
+TITLES_SNAPSHOT_MAX_AGE_SECONDS = float(
+    os.getenv("TITLES_SNAPSHOT_MAX_AGE_SECONDS", 60)
+)
+
+# How many processed titles a streaming job holds before writing them to the DB
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", 50))
+
+# Bounds for the in-process cache of /api/search results. New titles only show up
+# in a cached query's results once it expires
+SEARCH_CACHE_MAXSIZE = int(os.getenv("SEARCH_CACHE_MAXSIZE", 10_000))
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", 300))
+
+# How often the redirect alias map is reloaded from the availability table
+ALIAS_RELOAD_SECONDS = float(os.getenv("ALIAS_RELOAD_SECONDS", 600))
+
+# What happens to the unfinished titles of a job whose client disconnected:
+# "cancel" drops them, "enqueue" hands them to the background crawl workers
+ON_DISCONNECT = os.getenv("ON_DISCONNECT", "cancel")
+
+
+global_job_store = PostgresJobStore(PSYCOPG_CONNINFO)
+request_counter = RequestCounter()
+title_cache = TitleCache(
+    TITLE_CACHE_MAXSIZE, TITLE_CACHE_TTL_SECONDS, TITLE_CACHE_NEGATIVE_TTL_SECONDS
+)
+alias_index = AliasIndex()
+# Search-as-you-type repeats the same short prefixes a lot, and those are the
+# most expensive queries to answer
+search_cache = TTLCache(SEARCH_CACHE_MAXSIZE, SEARCH_CACHE_TTL_SECONDS)
+loop_lag_monitor = LoopLagMonitor()
+
 
+async def run_periodically(interval: float, fn):
+    """Runs the blocking `fn(session)` in a thread every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            with Session(engine) as session:
+                await asyncio.to_thread(fn, session)
+        except Exception as e:
+            logger.exception(e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    with Session(engine) as session:
+        await asyncio.to_thread(alias_index.load, session)
+    logger.info(f"Loaded {len(alias_index)} redirect aliases")
+    loop_lag_monitor.start()
+    with Session(engine) as session:
+        await asyncio.to_thread(rating_estimator.fit, session)
+    logger.info(f"Fitted rating estimator: {rating_estimator.stats()}")
+
+    periodic_tasks = [
+        asyncio.create_task(
+            run_periodically(REQUEST_COUNT_FLUSH_SECONDS, request_counter.flush)
+        ),
+        asyncio.create_task(
+            run_periodically(JOB_PRUNE_SECONDS, global_job_store.prune)
+        ),
+        # Picks up redirects recorded by other processes
+        asyncio.create_task(run_periodically(ALIAS_RELOAD_SECONDS, alias_index.load)),
+        asyncio.create_task(
+            run_periodically(ESTIMATE_REFIT_SECONDS, rating_estimator.fit)
+        ),
+    ]
+    yield
+    loop_lag_monitor.stop()
+    for task in periodic_tasks:
+        task.cancel()
+    shutdown_parse_executor()
+    with Session(engine) as session:
+        request_counter.flush(session)
 
-available_country = "US"
-engine = create_engine(DATABASE_URL, echo=True)
-global_job_store = JobStore()
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/title", StaticFiles(directory=DOWNLOADED_TITLEPAGES_DIR, html=True))
 templates = Jinja2Templates(directory=THIS_DIR / "templates")
 
@@ -78,6 +187,7 @@ app.add_middleware(
         "Cache-Control",
         "Connection",
         "X-Accel-Buffering",
+        "X-Profile-Id",
     ],
 )
 
@@ -95,7 +205,9 @@ async def get_extra_info(request: Request, response: Response):
             "url": request.url.path,
             # request.headers is supposed to be a mapping that handles duplicate keys
             # so coercing to dict is prone to break but ¯\_(ツ)_/¯
-            "headers": dict(request.headers),
+            "headers": {
+                k: v for k, v in request.headers.items() if k != "x-admin-token"
+            },
             "method": request.method,
             "http_version": request.scope["http_version"],
             "original_url": request.url.path,
@@ -106,6 +218,8 @@ async def get_extra_info(request: Request, response: Response):
             "status_code": response.status_code,
             "status": STATUS_REASONS.get(response.status_code),
             "headers": dict(response.headers),
+            # Logged after the body is sent, so this spans the whole (streamed) response
+            "elapsed_ms": (time.perf_counter() - request.state.start) * 1000,
         },
     }
 
@@ -123,6 +237,7 @@ async def write_log_data(request, response):
 
 @app.middleware("http")
 async def log_request(request: Request, call_next):
+    request.state.start = time.perf_counter()
     try:
         request.request_body = await request.json()
     except json.decoder.JSONDecodeError:
@@ -134,6 +249,12 @@ async def log_request(request: Request, call_next):
     return response
 
 
+# The last middleware added is the outermost, so this is registered after
+# `log_request`: profiles include every other middleware (request body parsing,
+# the JSON log write) and the whole streamed body
+app.add_middleware(ProfilingMiddleware)
+
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     files = [
@@ -144,14 +265,6 @@ async def read_root(request: Request):
     )
 
 
-def get_session():
-    with Session(engine) as session:
-        yield session
-
-
-DatabaseSessionDep = Annotated[Session, Depends(get_session)]
-
-
 class TitlesPostedResponse(BaseModel):
     job_id: str
     payload_sent: list[int]
@@ -166,6 +279,12 @@ class TitleResponse(BaseModel):
     release_year: Optional[int] = None
     runtime: Optional[int] = None
     google_users_rating: Optional[int] = None
+    # Only set when there's no Google users rating, see estimates.py
+    estimated_google_users_rating: Optional[int] = None
+    estimate_confident: Optional[bool] = None
+    # Set on the estimate a streaming job sends while it's still looking up the
+    # rating; the title's next message replaces it
+    provisional: Optional[bool] = None
 
     @staticmethod
     def find_google_users_rating(ratings: list[dict]) -> Optional[int]:
@@ -173,6 +292,14 @@ class TitleResponse(BaseModel):
             if rating["vendor"] == "Google users":
                 return rating["rating"]
 
+    def add_estimate(self, ratings: dict[str, int]) -> "TitleResponse":
+        if self.google_users_rating is None:
+            estimate = rating_estimator.estimate(ratings)
+            if estimate is not None:
+                self.estimated_google_users_rating = estimate.rating
+                self.estimate_confident = estimate.confident
+        return self
+
 
 class TitleResponseDecoder(json.JSONEncoder):
     def default(self, obj):
@@ -181,9 +308,10 @@ class TitleResponseDecoder(json.JSONEncoder):
         return super().default(obj)
 
 
-@app.get("/api/title/{title_id}", response_model=Dict[int, TitleResponse])
-def get_title(title_id: int, session: DatabaseSessionDep):
-    title = session.exec(
+def query_title_responses(
+    session: Session, netflix_ids: list[int]
+) -> dict[int, TitleResponse]:
+    titles = session.exec(
         select(
             Title.id,
             Title.netflix_id,
@@ -197,17 +325,257 @@ def get_title(title_id: int, session: DatabaseSessionDep):
             Rating,
             (Rating.netflix_id == Title.netflix_id) & (Rating.vendor == "Google users"),
         )
-        .where(Title.netflix_id == title_id)
-    ).first()
+        .where(Title.netflix_id.in_(netflix_ids))
+    ).all()
+
+    title_responses = {
+        title.netflix_id: TitleResponse(**title._mapping) for title in titles
+    }
+    unrated = [
+        netflix_id
+        for netflix_id, title_response in title_responses.items()
+        if title_response.google_users_rating is None
+    ]
+    if unrated:
+        stored_ratings = load_vendor_ratings(session, unrated)
+        for netflix_id in unrated:
+            title_responses[netflix_id].add_estimate(stored_ratings.get(netflix_id, {}))
+
+    return title_responses
+
+
+def lookup_cached_titles(
+    session: Session, netflix_ids: list[int], country: str
+) -> dict[int, TitleResponse]:
+    found = {}
+    misses = []
+    for netflix_id in dict.fromkeys(netflix_ids):
+        hit, title_response = title_cache.get((netflix_id, country))
+        if not hit:
+            misses.append(netflix_id)
+        elif title_response is not None:
+            found[netflix_id] = title_response
+
+    if misses:
+        fetched = query_title_responses(session, misses)
+        for netflix_id in misses:
+            # Unknown titles are cached too (briefly) so they don't hit the DB every time
+            title_response = fetched.get(netflix_id)
+            title_cache.set((netflix_id, country), title_response)
+            if title_response is not None:
+                found[netflix_id] = title_response
+
+    return found
+
+
+# Keyed by the requested IDs; a redirected ID gets its canonical title if that's stored
+def lookup_titles(
+    session: Session, netflix_ids: list[int], country: str
+) -> dict[int, TitleResponse]:
+    canonical_ids = {
+        netflix_id: alias_index.resolve(netflix_id, country)
+        for netflix_id in netflix_ids
+    }
+    found = lookup_cached_titles(session, list(canonical_ids.values()), country)
+
+    titles = {}
+    fallbacks = []
+    for netflix_id, canonical_id in canonical_ids.items():
+        if canonical_id in found:
+            titles[netflix_id] = found[canonical_id]
+        elif canonical_id != netflix_id:
+            fallbacks.append(netflix_id)
+
+    if fallbacks:
+        titles.update(lookup_cached_titles(session, fallbacks, country))
+
+    return titles
+
+
+def resolve_aliases(
+    session: Session, netflix_ids: list[int], country: str
+) -> tuple[dict[int, TitleResponse], list[int]]:
+    aliases = {
+        netflix_id: alias_index.resolve(netflix_id, country)
+        for netflix_id in netflix_ids
+        if alias_index.resolve(netflix_id, country) != netflix_id
+    }
+    canonical_titles = (
+        lookup_cached_titles(session, list(aliases.values()), country)
+        if aliases
+        else {}
+    )
+    resolved = {
+        alias: canonical_titles[canonical_id]
+        for alias, canonical_id in aliases.items()
+        if canonical_id in canonical_titles
+    }
+    return resolved, [
+        netflix_id for netflix_id in netflix_ids if netflix_id not in resolved
+    ]
+
+
+# Called from a job's pipeline, hence its own session
+def lookup_stored_canonical(netflix_id: int, country: str) -> Optional[TitleResponse]:
+    canonical_id = alias_index.resolve(netflix_id, country)
+    with Session(engine) as session:
+        title_response = lookup_cached_titles(session, [canonical_id], country).get(
+            canonical_id
+        )
+    if title_response is None or title_response.google_users_rating is None:
+        return None
+    return title_response
+
+
+def resolve_recently_crawled(
+    session: Session, netflix_ids: list[int], country: str
+) -> tuple[dict[int, TitleResponse], list[int]]:
+    crawled = recently_crawled(session, netflix_ids, country)
+    resolved = lookup_cached_titles(session, crawled, country) if crawled else {}
+    return resolved, [
+        netflix_id for netflix_id in netflix_ids if netflix_id not in resolved
+    ]
+
+
+# Aliases and fresh titles are answered from stored data, the rest is fetched
+def resolve_payload(
+    session: Session, netflix_ids: list[int], country: str
+) -> tuple[dict[int, TitleResponse], dict[int, TitleResponse], list[int]]:
+    resolved_aliases, to_fetch = resolve_aliases(session, netflix_ids, country)
+    resolved_crawled, to_fetch = resolve_recently_crawled(session, to_fetch, country)
+    return resolved_aliases, resolved_crawled, to_fetch
+
+
+def count_requests(titles: dict[int, TitleResponse], country: str):
+    # Only stored titles count towards crawl priority, so looking up arbitrary IDs
+    # can't queue them ahead of real refresh work
+    for netflix_id in titles:
+        request_counter.record(netflix_id, country)
+
+
+def format_title_message(netflix_id: int, title_response: TitleResponse) -> str:
+    return json.dumps(
+        {netflix_id: title_response},
+        separators=(",", ":"),
+        cls=TitleResponseDecoder,
+    )
+
+
+@app.get("/api/title/{title_id}", response_model=Dict[int, TitleResponse])
+def get_title(
+    title_id: int,
+    session: DatabaseSessionDep,
+    country: Annotated[str | None, Query()] = "US",
+):
+    titles = lookup_titles(session, [title_id], country)
 
-    if title is None:
+    if not titles:
         raise HTTPException(status_code=404, detail="Title not found")
 
-    return {title.netflix_id: title}
+    count_requests(titles, country)
+    return titles
 
 
-@app.get("/api/titles", response_model=Dict[int, TitleResponse])
-def get_all_available_titles(session: DatabaseSessionDep):
+@app.post("/api/title/batch", response_model=Dict[int, TitleResponse])
+def get_titles_batch(
+    payload: list[int],
+    session: DatabaseSessionDep,
+    country: Annotated[str | None, Query()] = "US",
+):
+    titles = lookup_titles(session, payload, country)
+    count_requests(titles, country)
+    return titles
+
+
+@app.get("/api/metrics")
+def get_metrics(session: DatabaseSessionDep):
+    return {
+        "title_cache": title_cache.stats(),
+        "titles_snapshot": titles_snapshot.stats(),
+        "pipeline": pipeline_metrics(),
+        "serp_spend": get_spend_today(session),
+        "event_loop": loop_lag_monitor.stats(),
+        "rating_estimator": rating_estimator.stats(),
+        "search_cache": search_cache.stats(),
+        "prefetch": get_prefetch_stats(session),
+    }
+
+
+@app.get("/api/admin/profiles", dependencies=[AdminDep])
+def list_profiles():
+    return profile_store.list()
+
+
+@app.get("/api/admin/profiles/{profile_id}", dependencies=[AdminDep])
+def get_profile(profile_id: str):
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if profile.data is None:
+        raise HTTPException(status_code=409, detail="Profile is still being captured")
+
+    extension = "pstats" if profile.kind == "cprofile" else "collapsed"
+    return Response(
+        content=profile.data,
+        media_type="application/octet-stream"
+        if profile.kind == "cprofile"
+        else "text/plain",
+        headers={
+            "Content-Disposition": f'attachment; filename="{profile.id}.{extension}"'
+        },
+    )
+
+
+class SearchResult(TitleResponse):
+    score: float
+
+
+@app.get("/api/search", response_model=list[SearchResult])
+def search(
+    session: DatabaseSessionDep,
+    q: Annotated[str, Query(min_length=1, max_length=100)],
+    limit: Annotated[int, Query(ge=1, le=SEARCH_MAX_LIMIT)] = SEARCH_DEFAULT_LIMIT,
+):
+    q = normalize_query(q)
+    if not q:
+        return []
+
+    # Results are cached per query rather than per limit: with candidates bounded
+    # (see search.py), the most results cost about the same as the default number
+    hit, results = search_cache.get(q)
+    if not hit:
+        results = narrow_cached_prefix_search(q)
+        if results is None:
+            rows = search_titles(session, q, SEARCH_MAX_LIMIT)
+            results = [SearchResult(**row) for row in rows]
+        search_cache.set(q, results)
+    return results[:limit]
+
+
+def narrow_cached_prefix_search(q: str) -> Optional[list[SearchResult]]:
+    """
+    Answers a prefix-only query from the cached results of a shorter one, when
+    those are complete (fewer than SEARCH_MAX_LIMIT), by filtering them: as someone
+    types, the matches can only narrow. Trigram matches don't narrow like that,
+    since a longer query can be more similar to a title than its prefix was.
+    """
+    if len(q) >= SEARCH_MIN_TRIGRAM_QUERY:
+        return None
+    for end in range(len(q) - 1, 0, -1):
+        hit, shorter = search_cache.get(q[:end])
+        if hit:
+            if len(shorter) == SEARCH_MAX_LIMIT:
+                # Even shorter prefixes have at least as many matches
+                return None
+            return [
+                result
+                for result in shorter
+                if (result.title or "").lower().startswith(q)
+            ]
+    return None
+
+
+def query_available_titles(session: Session) -> dict[int, TitleResponse]:
     titles = session.exec(
         select(
             Title.id,
@@ -244,9 +612,6 @@ def get_all_available_titles(session: DatabaseSessionDep):
         )
     ).all()
 
-    if titles is None:
-        raise HTTPException(status_code=404, detail="No titles not found")
-
     response_obj = {}
     for title in titles:
         title_response = TitleResponse(
@@ -263,189 +628,295 @@ def get_all_available_titles(session: DatabaseSessionDep):
     return response_obj
 
 
-@app.post("/api/titles", response_model=TitlesPostedResponse)
-async def store_title_ids_for_processing(
-    payload: list[int], country: Annotated[str | None, Query()] = "US"
-):
-    global available_country
-    available_country = country
-    job_id = str(uuid4())
-    global_job_store[job_id] = payload
-    return {
-        "job_id": job_id,
-        "country": country,
-        "payload_sent": payload,
-        "actual_payload_to_submit": global_job_store[job_id],
-    }
+def build_titles_snapshot() -> bytes:
+    with Session(engine) as session:
+        titles = query_available_titles(session)
+    return json.dumps(titles, separators=(",", ":"), cls=TitleResponseDecoder).encode()
 
 
-async def fetch_and_process_title(
-    title_id: int,
-    session_handler: NetflixSessionHandler,
-    background_tasks: BackgroundTasks,
-) -> list[dict]:
-    request_path = f"title/{title_id}"
-    async with session_handler.limiter:
-        try:
-            async with session_handler.noauth_session.get(request_path) as response:
-                logger.info(f"Starting request for {request_path}")
-                if response.status not in (200, 301, 302, 404):
-                    response.raise_for_status()
+titles_snapshot = SnapshotCache(
+    build_titles_snapshot, max_age=TITLES_SNAPSHOT_MAX_AGE_SECONDS
+)
 
-                html_content = HTMLContent(await response.text())
 
-                background_tasks.add_task(
-                    save_response_body,
-                    html_content,
-                    DOWNLOADED_TITLEPAGES_DIR / f"{title_id}.html",
-                )
+@app.get("/api/titles", response_model=Dict[int, TitleResponse])
+def get_all_available_titles(request: Request):
+    # Served straight from pre-encoded bytes, only re-serialized when the data changes
+    snapshot = titles_snapshot.get()
+    encoding = snapshot.negotiate(request.headers.get("accept-encoding"))
+    etag = snapshot.etag_for(encoding)
+    headers = {
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": f"public, max-age={int(TITLES_SNAPSHOT_MAX_AGE_SECONDS)}",
+    }
 
-                return extract_netflix_react_context(html_content)
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
 
-        except (ContextExtractionError, aiohttp.ConnectionTimeoutError) as e:
-            logger.exception(e)
-            return []
-
-
-async def scrape_serp_for_ratings(
-    netflix_id,
-    title_data,
-    brd_session_handler: BrightDataSessionHandler,
-    background_tasks: BackgroundTasks,
-) -> list[dict]:
-    async with brd_session_handler.limiter:
-        logger.info(f"Attempting to get SERP reviews for {netflix_id}")
-        if not title_data:
-            return []
-        serp_response = await get_serp_html(
-            netflix_id,
-            get_field(title_data, "title"),
-            get_field(title_data, "content_type"),
-            get_field(title_data, "release_year"),
-            session=brd_session_handler.choose_session(),
-        )
-        background_tasks.add_task(
-            save_response_body,
-            serp_response.html,
-            DOWNLOADED_SERP_PAGES_DIR / f"{netflix_id}.html",
-        )
-        return [rating.__dict__ for rating in serp_response.ratings]
+    if encoding != IDENTITY:
+        headers["Content-Encoding"] = encoding
 
-
-async def download_title_and_lookup_ratings(
-    title_id,
-    nflx_session_handler: NetflixSessionHandler,
-    brd_session_handler: BrightDataSessionHandler,
-    background_tasks: BackgroundTasks,
-) -> dict[str, Any]:
-    title_data = await fetch_and_process_title(
-        title_id,
-        nflx_session_handler,
-        background_tasks,
+    # Response sets Content-Length from the body
+    return Response(
+        content=snapshot.bodies[encoding],
+        media_type="application/json",
+        headers=headers,
     )
+
+
+@app.post("/api/titles", response_model=TitlesPostedResponse)
+def store_title_ids_for_processing(
+    payload: list[int],
+    session: DatabaseSessionDep,
+    country: Annotated[str | None, Query()] = "US",
+):
+    job = global_job_store.create(session, payload, country)
+    _, _, actual_payload_to_submit = resolve_payload(session, payload, country)
     return {
-        "netflix_id": title_id,
-        "react_context": title_data,
-        "ratings": await scrape_serp_for_ratings(
-            title_id, title_data, brd_session_handler, background_tasks
-        ),
+        "job_id": str(job.id),
+        "country": country,
+        "payload_sent": payload,
+        "actual_payload_to_submit": actual_payload_to_submit,
     }
 
 
 async def stream_ratings(
-    job_id: str, db_session: DatabaseSessionDep, background_tasks: BackgroundTasks
+    job: Job, db_session: DatabaseSessionDep, background_tasks: BackgroundTasks
 ):
-    tasks = []
     nflx_session_handler = NetflixSessionHandler()
     brd_session_handler = BrightDataSessionHandler()
 
-    for title_id in global_job_store[job_id]:
-        task = asyncio.create_task(
-            download_title_and_lookup_ratings(
-                title_id, nflx_session_handler, brd_session_handler, background_tasks
-            ),
-            name=title_id,
+    resolved_aliases, resolved_crawled, payload_to_fetch = await asyncio.to_thread(
+        resolve_payload, db_session, job.payload, job.country
+    )
+    hits = await asyncio.to_thread(
+        record_requests, db_session, job.payload, list(resolved_crawled), job.country
+    )
+    if resolved_crawled:
+        logger.info(
+            f"Job {job.id} answered {len(resolved_crawled)} titles from stored data "
+            f"({hits} prefetched)"
         )
-        task.add_done_callback(
-            lambda t: logger.info(f"Finished task for {t.get_name()}")
+
+    # Titles whose other vendors' ratings confidently predict the Google users
+    # rating don't need a SERP lookup
+    stored_ratings = await asyncio.to_thread(
+        load_vendor_ratings, db_session, payload_to_fetch
+    )
+    skip_serp = set()
+    if ESTIMATE_SKIP_SERP:
+        for netflix_id, ratings in stored_ratings.items():
+            estimate = rating_estimator.estimate(ratings)
+            if TARGET_VENDOR not in ratings and estimate and estimate.confident:
+                skip_serp.add(netflix_id)
+
+    # Titles flow through bounded stages, so memory use doesn't grow with the payload
+    budget = SerpBudget()
+    pipeline = build_title_pipeline(
+        nflx_session_handler,
+        brd_session_handler,
+        background_tasks,
+        budget,
+        skip_serp,
+        lookup_canonical=functools.partial(
+            lookup_stored_canonical, country=job.country
+        ),
+    )
+    records = RecordBuffer()
+    written = set()
+    requested = set(job.payload)
+    related = {}
+    emitted = set()
+    provisional = set()
+    completed = False
+    seq = 0
+    answered = 0
+
+    async def flush_records():
+        await asyncio.to_thread(records.flush, db_session)
+        # What was stored may differ from what the job streamed (e.g. an existing
+        # rating is kept when the SERP lookup found nothing), so the next lookup
+        # re-reads it rather than being served the job's version
+        for netflix_id in written:
+            title_cache.invalidate_title(netflix_id)
+        written.clear()
+        titles_snapshot.mark_stale()
+
+        # Related titles are likely to be asked for next, so they're queued for prefetching
+        to_prefetch = [
+            netflix_id for netflix_id in related if netflix_id not in requested
+        ]
+        related.clear()
+        if to_prefetch:
+            await asyncio.to_thread(
+                enqueue_related, db_session, to_prefetch, job.country
+            )
+
+    # Fetching and SERP lookups can take a while between results, which mustn't
+    # make the job look abandoned
+    heartbeat = asyncio.create_task(
+        run_periodically(
+            JOB_HEARTBEAT_SECONDS,
+            functools.partial(global_job_store.heartbeat, job_id=job.id),
         )
-        tasks.append(task)
+    )
 
     try:
-        titles = []
-        availability = []
-        ratings = defaultdict(list)
+        # Aliases of titles we already have, and titles crawled recently, are
+        # answered straight away
+        for netflix_id, title_response in [
+            *resolved_aliases.items(),
+            *resolved_crawled.items(),
+        ]:
+            msg = format_title_message(netflix_id, title_response)
+            await asyncio.to_thread(
+                global_job_store.publish, db_session, job.id, seq, msg
+            )
+            seq += 1
+            answered += 1
+            yield f"data: {msg}" + "\n\n"
+
+        # Titles whose stored ratings give a confident estimate get it straight
+        # away, and their actual result once the pipeline gets to them
+        for netflix_id in dict.fromkeys(payload_to_fetch):
+            ratings = stored_ratings.get(netflix_id)
+            if not ratings or TARGET_VENDOR in ratings:
+                continue
+            title_response = TitleResponse(
+                netflix_id=netflix_id, provisional=True
+            ).add_estimate(ratings)
+            if not title_response.estimate_confident:
+                continue
+            msg = format_title_message(netflix_id, title_response)
+            await asyncio.to_thread(
+                global_job_store.publish, db_session, job.id, seq, msg
+            )
+            seq += 1
+            provisional.add(netflix_id)
+            yield f"data: {msg}" + "\n\n"
 
         # TODO it may be prudent to yield a ': keep-alive' message every so often
-        for completed_coro in asyncio.as_completed(tasks):
-            result = await completed_coro
-
-            netflix_id = result["netflix_id"]
-            title_data = result["react_context"]
-
-            title = Title(
-                netflix_id=netflix_id,
-                title=get_field(title_data, "title"),
-                content_type=get_field(title_data, "content_type"),
-                release_year=get_field(title_data, "release_year"),
-                runtime=get_field(title_data, "runtime"),
-                meta_data=title_data,
-            )
-            titles.append(title)
-
-            availability.append(
-                Availability(
-                    netflix_id=netflix_id,
-                    country=available_country,
-                    titlepage_reachable=True,
-                    available=True,
+        async with aclosing(pipeline.run(payload_to_fetch)) as results:
+            async for result in results:
+                logger.info(f"Finished task for {result['netflix_id']}")
+                emitted.add(result["netflix_id"])
+                related.update(
+                    dict.fromkeys(related_title_ids(result["react_context"]))
                 )
-            )
 
-            for rating in result["ratings"]:
-                ratings[netflix_id].append(
-                    Rating(
-                        netflix_id=netflix_id,
-                        vendor=rating["vendor"],
-                        url=rating["url"],
-                        rating=rating["rating"],
-                        ratings_count=rating["ratings_count"],
+                if result["redirected_netflix_id"] is not None:
+                    alias_index.add(
+                        result["netflix_id"],
+                        result["redirected_netflix_id"],
+                        job.country,
                     )
+
+                title = records.add(result, job.country)
+                if result.get("canonical") is not None:
+                    # Redirected to a title we already have, which answers for it
+                    title_response = result["canonical"]
+                else:
+                    ratings = {
+                        rating["vendor"]: rating["rating"]
+                        for rating in result["ratings"]
+                    } or stored_ratings.get(result["netflix_id"], {})
+                    title_response = TitleResponse(
+                        **title.model_dump(),
+                        google_users_rating=TitleResponse.find_google_users_rating(
+                            result["ratings"]
+                        ),
+                    ).add_estimate(ratings)
+                written.add(title.netflix_id)
+                msg = format_title_message(title.netflix_id, title_response)
+
+                # Make the message available to other workers relaying this job
+                await asyncio.to_thread(
+                    global_job_store.publish, db_session, job.id, seq, msg
                 )
+                seq += 1
+                answered += 1
 
-            title_response = TitleResponse(
-                **title.model_dump(),
-                google_users_rating=TitleResponse.find_google_users_rating(
-                    result["ratings"]
-                ),
-            )
-            msg = json.dumps(
-                {title.netflix_id: title_response},
-                separators=(",", ":"),
-                cls=TitleResponseDecoder,
-            )
+                yield (
+                    f"data: {msg}" + "\n\n"
+                )  # https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events#event_stream_format
 
-            yield (
-                f"data: {msg}" + "\n\n"
-            )  # https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events#event_stream_format
+                if len(records) >= PERSIST_BATCH_SIZE:
+                    await flush_records()
 
+        completed = True
     finally:
-        await nflx_session_handler.close()
-        await brd_session_handler.close()
+        # A client disconnect lands here with titles still in flight: stop spending
+        # fetches and SERP requests on them
+        pipeline.cancel()
 
-        db_session.exec(Title.bulk_insert_ignore_conflicts(titles))
-        db_session.exec(Availability.bulk_insert_ignore_conflicts(availability))
-        db_session.exec(
-            Rating.bulk_insert_ignore_conflicts(itertools.chain(*ratings.values()))
-        )
-        db_session.commit()
+        try:
+            # On disconnect Starlette cancels the task streaming the response, and that
+            # cancellation would hit every await below, skipping the rest of the cleanup
+            with anyio.CancelScope(shield=True):
+                await nflx_session_handler.close()
+                await brd_session_handler.close()
+
+                await flush_records()
+
+                if not completed:
+                    remaining = [
+                        netflix_id
+                        for netflix_id in dict.fromkeys(payload_to_fetch)
+                        if netflix_id not in emitted
+                    ]
+                    logger.info(
+                        f"Job {job.id} stopped with {len(remaining)} titles unfinished "
+                        f"(on disconnect: {ON_DISCONNECT})"
+                    )
+                    if ON_DISCONNECT == "enqueue":
+                        await asyncio.to_thread(
+                            enqueue_titles, db_session, remaining, job.country
+                        )
+
+                    # Provisional estimates are never left without a final answer,
+                    # at least for workers relaying the job
+                    for netflix_id in remaining:
+                        if netflix_id not in provisional:
+                            continue
+                        title_response = TitleResponse(
+                            netflix_id=netflix_id
+                        ).add_estimate(stored_ratings[netflix_id])
+                        msg = format_title_message(netflix_id, title_response)
+                        await asyncio.to_thread(
+                            global_job_store.publish, db_session, job.id, seq, msg
+                        )
+                        seq += 1
+
+                if skip_serp:
+                    logger.info(f"Job {job.id} skipped {len(skip_serp)} SERP lookups")
+                spend = budget.report()
+                logger.info(f"SERP spend for job {job.id}: {spend}")
+                await asyncio.to_thread(
+                    global_job_store.finish,
+                    db_session,
+                    job.id,
+                    complete=answered == len(job.payload),
+                    serp_requests=spend["spent"],
+                    serp_blocked=spend["blocked_by_job_cap"]
+                    + spend["blocked_by_day_cap"],
+                )
+        finally:
+            heartbeat.cancel()
 
 
 @app.get("/api/stream/{job_id}", response_model=Dict[int, TitleResponse])
 async def stream_data(
-    job_id: str, db_session: DatabaseSessionDep, background_tasks: BackgroundTasks
+    job_id: UUID, db_session: DatabaseSessionDep, background_tasks: BackgroundTasks
 ):
-    return StreamingResponse(
-        stream_ratings(job_id, db_session, background_tasks),
-        media_type="text/event-stream",
-    )
+    # Whichever worker gets here first executes the job, any others relay its results
+    job = await asyncio.to_thread(global_job_store.claim, db_session, job_id)
+    if job is not None:
+        stream = stream_ratings(job, db_session, background_tasks)
+    elif await asyncio.to_thread(global_job_store.get, db_session, job_id) is not None:
+        stream = global_job_store.relay(job_id)
+    else:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return StreamingResponse(stream, media_type="text/event-stream")
@@ -2,6 +2,7 @@
 import sys
 import json
 import logging
+import logging.handlers
 
 
 class CustomJSONFormatter(logging.Formatter):
@@ -34,7 +35,10 @@ class CustomJSONFormatter(logging.Formatter):
 
 
 def get_file_handler(formatter, filename):
-    file_handler = logging.handlers.RotatingFileHandler(filename)
+    # Every hypercorn worker and parser process appends to the same files, so none
+    # of them can rotate safely. logrotate does it (see logrotate.conf), and this
+    # handler reopens a file once it's been moved
+    file_handler = logging.handlers.WatchedFileHandler(filename)
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
     return file_handler
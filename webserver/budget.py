@@ -0,0 +1,147 @@
+import os
+import asyncio
+import threading
+from typing import Any, Optional
+from datetime import datetime, timezone, timedelta, time
+
+from database import engine
+from sqlmodel import Session
+from sqlalchemy import text
+
+# Caps on Bright Data SERP requests; 0 means unlimited
+SERP_CAP_PER_JOB = int(os.getenv("SERP_CAP_PER_JOB", 0))
+SERP_CAP_PER_DAY = int(os.getenv("SERP_CAP_PER_DAY", 0))
+
+
+class SerpBudgetExhausted(Exception):
+    """A SERP request was blocked by the per-job or per-day cap."""
+
+
+def spend_today(session: Session, cap: int) -> bool:
+    """
+    Atomically counts one SERP request against today's (UTC) total, unless the
+    total has reached `cap`. The count lives in Postgres so every process shares it.
+    """
+    row = session.exec(
+        text(
+            """
+            INSERT INTO serp_spend (day, requests)
+            VALUES (timezone('utc', now())::date, 1)
+            ON CONFLICT (day) DO UPDATE
+            SET requests = serp_spend.requests + 1
+            WHERE :cap <= 0 OR serp_spend.requests < :cap
+            RETURNING requests
+            """
+        ).bindparams(cap=cap)
+    ).first()
+
+    if row is None:
+        session.exec(
+            text(
+                """
+                UPDATE serp_spend
+                SET blocked_by_day_cap = blocked_by_day_cap + 1
+                WHERE day = timezone('utc', now())::date
+                """
+            )
+        )
+    session.commit()
+    return row is not None
+
+
+def record_blocked_by_job_cap(session: Session):
+    session.exec(
+        text(
+            """
+            INSERT INTO serp_spend (day, blocked_by_job_cap)
+            VALUES (timezone('utc', now())::date, 1)
+            ON CONFLICT (day) DO UPDATE
+            SET blocked_by_job_cap = serp_spend.blocked_by_job_cap + 1
+            """
+        )
+    )
+    session.commit()
+
+
+def get_spend_today(session: Session) -> dict[str, Any]:
+    row = session.exec(
+        text(
+            """
+            SELECT requests, blocked_by_job_cap, blocked_by_day_cap
+            FROM serp_spend
+            WHERE day = timezone('utc', now())::date
+            """
+        )
+    ).first()
+    requests, blocked_by_job_cap, blocked_by_day_cap = row or (0, 0, 0)
+    return {
+        "requests": requests,
+        "cap": SERP_CAP_PER_DAY or None,
+        "blocked_by_job_cap": blocked_by_job_cap,
+        "blocked_by_day_cap": blocked_by_day_cap,
+    }
+
+
+def day_cap_reached(session: Session, cap: int = SERP_CAP_PER_DAY) -> bool:
+    return cap > 0 and get_spend_today(session)["requests"] >= cap
+
+
+def next_day() -> datetime:
+    """The start of the next UTC day, when the per-day cap resets."""
+    today = datetime.now(timezone.utc).date()
+    return datetime.combine(today + timedelta(days=1), time.min)
+
+
+class SerpBudget:
+    """
+    Decides whether a SERP request may go ahead, given a per-job cap (tracked
+    here) and a per-day cap (tracked in the `serp_spend` table), and keeps count
+    of what was spent and what each cap blocked.
+    """
+
+    def __init__(
+        self,
+        per_job_cap: Optional[int] = SERP_CAP_PER_JOB,
+        per_day_cap: int = SERP_CAP_PER_DAY,
+    ):
+        self.per_job_cap = per_job_cap
+        self.per_day_cap = per_day_cap
+        self._lock = threading.Lock()
+        self.spent = 0
+        self.blocked_by_job_cap = 0
+        self.blocked_by_day_cap = 0
+
+    def _try_spend(self) -> bool:
+        # Reserve the request up front so concurrent callers can't overshoot the job cap
+        with self._lock:
+            blocked_by_job_cap = (
+                bool(self.per_job_cap) and self.spent >= self.per_job_cap
+            )
+            if blocked_by_job_cap:
+                self.blocked_by_job_cap += 1
+            else:
+                self.spent += 1
+
+        with Session(engine) as session:
+            if blocked_by_job_cap:
+                record_blocked_by_job_cap(session)
+                return False
+
+            if not spend_today(session, self.per_day_cap):
+                with self._lock:
+                    self.spent -= 1
+                    self.blocked_by_day_cap += 1
+                return False
+
+        return True
+
+    async def try_spend(self) -> bool:
+        return await asyncio.to_thread(self._try_spend)
+
+    def report(self) -> dict[str, Any]:
+        return {
+            "spent": self.spent,
+            "per_job_cap": self.per_job_cap or None,
+            "blocked_by_job_cap": self.blocked_by_job_cap,
+            "blocked_by_day_cap": self.blocked_by_day_cap,
+        }
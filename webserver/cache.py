@@ -0,0 +1,136 @@
+import sys
+import time
+import threading
+from typing import Any, Callable, Hashable, Optional
+from collections import OrderedDict, defaultdict
+
+_MISSING = object()
+
+
+def sizeof_model(obj: Any) -> int:
+    """Rough in-memory size of a (pydantic) model: the object, its fields and their values."""
+    if obj is None:
+        return sys.getsizeof(obj)
+    fields = getattr(obj, "__dict__", {})
+    return (
+        sys.getsizeof(obj)
+        + sys.getsizeof(fields)
+        + sum(sys.getsizeof(value) for value in fields.values())
+    )
+
+
+class TTLCache:
+    """
+    A thread-safe, size-bounded LRU cache whose entries also expire after a TTL.
+
+    `None` is a legitimate value, which makes negative caching ("we know this
+    doesn't exist") a matter of `set(key, None, ttl=...)`.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        sizeof: Callable[[Any], int] = sys.getsizeof,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[float, Any, int]] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        """Returns `(hit, value)` so that a cached `None` can be told apart from a miss."""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value, _ = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                self._pop(key)
+            self.misses += 1
+            return False, None
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        size = sys.getsizeof(key) + self.sizeof(value)
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (expires_at, value, size)
+            self._bytes += size
+            while len(self._entries) > self.maxsize:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._pop(key)
+
+    def _pop(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+            self._on_pop(key)
+
+    def _on_pop(self, key: Hashable):
+        pass
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "approx_bytes": self._bytes,
+            }
+
+
+class TitleCache(TTLCache):
+    """
+    Caches `TitleResponse`s (or `None` for unknown titles) keyed by
+    `(netflix_id, country)`, and keeps track of which countries each title is
+    cached under so a title can be invalidated in one go.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float):
+        super().__init__(maxsize, ttl, sizeof=sizeof_model)
+        self.negative_ttl = negative_ttl
+        self._countries: defaultdict[int, set[str]] = defaultdict(set)
+
+    def set(self, key: tuple[int, str], value: Any, ttl: Optional[float] = None):
+        if value is None and ttl is None:
+            ttl = self.negative_ttl
+        super().set(key, value, ttl)
+        with self._lock:
+            if key in self._entries:
+                netflix_id, country = key
+                self._countries[netflix_id].add(country)
+
+    def invalidate_title(self, netflix_id: int):
+        """Drops whatever is cached for `netflix_id`, under any country."""
+        with self._lock:
+            for cached_country in list(self._countries.get(netflix_id, ())):
+                self._pop((netflix_id, cached_country))
+
+    def _on_pop(self, key: tuple[int, str]):
+        netflix_id, country = key
+        countries = self._countries.get(netflix_id)
+        if countries is not None:
+            countries.discard(country)
+            if not countries:
+                del self._countries[netflix_id]
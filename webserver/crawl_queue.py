@@ -0,0 +1,307 @@
+import os
+import threading
+import itertools
+from datetime import datetime, timezone, timedelta
+from collections import Counter
+from typing import Iterable
+
+from models import CrawlQueueEntry
+from sqlmodel import Session
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+# How long a title's ratings are considered fresh
+REFRESH_INTERVAL = timedelta(days=float(os.getenv("CRAWL_REFRESH_DAYS", 30)))
+
+# How long a claimed entry stays invisible to other workers
+LEASE_DURATION = timedelta(minutes=float(os.getenv("CRAWL_LEASE_MINUTES", 15)))
+
+
+def utcnow() -> datetime:
+    # The timestamp columns are `timestamp without time zone` holding UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class RequestCounter:
+    """
+    Tallies `/api/title/{id}` lookups in memory so the crawl queue can prioritize
+    popular titles without a write on every read. `flush` folds the tallies
+    into `crawl_queue.request_count`.
+    """
+
+    FLUSH_CHUNK_SIZE = 5_000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Counter[tuple[int, str]] = Counter()
+
+    def record(self, netflix_id: int, country: str):
+        with self._lock:
+            self._counts[(netflix_id, country)] += 1
+
+    def flush(self, session: Session):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+
+        if not counts:
+            return
+
+        now = utcnow()
+        for chunk in itertools.batched(counts.items(), self.FLUSH_CHUNK_SIZE):
+            # A title entering the queue here was last crawled whenever its stored
+            # data was checked, so it doesn't jump ahead of genuinely stale titles
+            session.exec(
+                text(
+                    """
+                    INSERT INTO crawl_queue (
+                        netflix_id, country, request_count, last_requested_at, last_crawled_at
+                    )
+                    SELECT
+                        requested.netflix_id,
+                        requested.country,
+                        requested.request_count,
+                        :now,
+                        GREATEST(
+                            (
+                                SELECT availability.checked_at
+                                FROM availability
+                                WHERE availability.netflix_id = requested.netflix_id
+                                    AND availability.country = requested.country
+                            ),
+                            (
+                                SELECT MAX(ratings.checked_at)
+                                FROM ratings
+                                WHERE ratings.netflix_id = requested.netflix_id
+                            )
+                        )
+                    FROM unnest(
+                        CAST(:netflix_ids AS BIGINT[]),
+                        CAST(:countries AS TEXT[]),
+                        CAST(:request_counts AS INTEGER[])
+                    ) AS requested (netflix_id, country, request_count)
+                    ON CONFLICT (country, netflix_id) DO UPDATE
+                    SET request_count = crawl_queue.request_count + excluded.request_count,
+                        last_requested_at = excluded.last_requested_at
+                    """
+                ).bindparams(
+                    now=now,
+                    netflix_ids=[netflix_id for (netflix_id, _), _ in chunk],
+                    countries=[country for (_, country), _ in chunk],
+                    request_counts=[count for _, count in chunk],
+                )
+            )
+        session.commit()
+
+
+def enqueue_known_titles(session: Session) -> int:
+    """Adds every available title to the crawl queue, seeded with its last check time."""
+    result = session.exec(
+        text(
+            """
+            INSERT INTO crawl_queue (netflix_id, country, last_crawled_at)
+            SELECT netflix_id, country, checked_at
+            FROM availability
+            WHERE available
+            ON CONFLICT (country, netflix_id) DO NOTHING
+            """
+        )
+    )
+    session.commit()
+    return result.rowcount
+
+
+def enqueue_titles(session: Session, netflix_ids: list[int], country: str):
+    """Makes `netflix_ids` due right away, e.g. for work a disconnected client left behind."""
+    if not netflix_ids:
+        return
+    stmt = insert(CrawlQueueEntry).values(
+        [{"netflix_id": netflix_id, "country": country} for netflix_id in netflix_ids]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=CrawlQueueEntry.UPSERT_INDEX_ELEMENTS,
+        set_={"last_crawled_at": None},
+    )
+    session.exec(stmt)
+    session.commit()
+
+
+# Entries the prefetcher added that it hasn't crawled yet (see prefetch.py)
+PENDING_PREFETCH = "prefetch_depth IS NOT NULL AND prefetched_at IS NULL"
+
+# Claims consider this many times `limit` due rows, read in index order. Refresh
+# claims then rank them by popularity-weighted staleness
+CLAIM_CANDIDATES_PER_SLOT = int(os.getenv("CRAWL_CLAIM_CANDIDATES_PER_SLOT", 20))
+
+
+def claim_due(
+    session: Session, limit: int, prefetch: bool = False
+) -> list[CrawlQueueEntry]:
+    """
+    Leases up to `limit` titles whose ratings are older than REFRESH_INTERVAL;
+    rows locked by other workers are skipped rather than waited on.
+
+    Refresh work is picked from the stalest due titles (off
+    `crawl_queue_due_idx`, see scripts/migrations/007_crawl_queue_due_idx.sql),
+    the most requested of them first, so a claim never scans the whole queue.
+    Titles queued by the prefetcher are only claimed with `prefetch=True`,
+    shallowest first.
+    """
+    now = utcnow()
+    if prefetch:
+        candidates = f"""
+            SELECT id
+            FROM crawl_queue
+            WHERE {PENDING_PREFETCH}
+                AND (last_crawled_at IS NULL OR last_crawled_at < :stale_before)
+                AND (leased_until IS NULL OR leased_until < :now)
+            ORDER BY prefetch_depth, id
+            LIMIT :candidates
+        """
+        order_by = "crawl_queue.prefetch_depth, crawl_queue.id"
+    else:
+        candidates = f"""
+            SELECT id
+            FROM crawl_queue
+            WHERE NOT ({PENDING_PREFETCH})
+                AND (last_crawled_at IS NULL OR last_crawled_at < :stale_before)
+                AND (leased_until IS NULL OR leased_until < :now)
+            ORDER BY last_crawled_at NULLS FIRST
+            LIMIT :candidates
+        """
+        order_by = """
+            EXTRACT(EPOCH FROM :now - COALESCE(crawl_queue.last_crawled_at, 'epoch'))
+            * (1 + ln(1 + crawl_queue.request_count)) DESC
+        """
+    rows = session.exec(
+        text(
+            f"""
+            WITH candidates AS ({candidates}),
+            due AS (
+                SELECT crawl_queue.id
+                FROM crawl_queue
+                JOIN candidates ON candidates.id = crawl_queue.id
+                ORDER BY {order_by}
+                LIMIT :limit
+                FOR UPDATE OF crawl_queue SKIP LOCKED
+            )
+            UPDATE crawl_queue
+            SET leased_until = :leased_until, attempts = attempts + 1
+            FROM due
+            WHERE crawl_queue.id = due.id
+            RETURNING crawl_queue.*
+            """
+        ).bindparams(
+            now=now,
+            stale_before=now - REFRESH_INTERVAL,
+            leased_until=now + LEASE_DURATION,
+            limit=limit,
+            candidates=limit * CLAIM_CANDIDATES_PER_SLOT,
+        )
+    ).all()
+    session.commit()
+    return [CrawlQueueEntry.model_validate(row._mapping) for row in rows]
+
+
+def recently_crawled(
+    session: Session, netflix_ids: list[int], country: str
+) -> list[int]:
+    """
+    The IDs among `netflix_ids` a worker crawled within REFRESH_INTERVAL, and that
+    have a parsed title page and a Google users rating to show for it.
+    """
+    if not netflix_ids:
+        return []
+    return list(
+        session.exec(
+            text(
+                """
+                SELECT crawl_queue.netflix_id
+                FROM crawl_queue
+                WHERE crawl_queue.country = :country
+                    AND crawl_queue.netflix_id = ANY(:netflix_ids)
+                    AND crawl_queue.last_crawled_at >= :fresh_after
+                    AND EXISTS (
+                        SELECT 1
+                        FROM title_metadata
+                        WHERE title_metadata.netflix_id = crawl_queue.netflix_id
+                    )
+                    AND EXISTS (
+                        SELECT 1
+                        FROM ratings
+                        WHERE ratings.netflix_id = crawl_queue.netflix_id
+                            AND ratings.vendor = 'Google users'
+                    )
+                """
+            ).bindparams(
+                country=country,
+                netflix_ids=list(netflix_ids),
+                fresh_after=utcnow() - REFRESH_INTERVAL,
+            )
+        ).scalars()
+    )
+
+
+def record_crawled(session: Session, titles: Iterable[tuple[int, str]]):
+    """
+    Marks `(netflix_id, country)` pairs whose data was just stored as crawled now,
+    so they aren't picked as refresh work. Doesn't commit.
+    """
+    rows = [
+        {"netflix_id": netflix_id, "country": country, "last_crawled_at": utcnow()}
+        for netflix_id, country in dict.fromkeys(titles)
+    ]
+    if not rows:
+        return
+    stmt = insert(CrawlQueueEntry).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=CrawlQueueEntry.UPSERT_INDEX_ELEMENTS,
+        set_={"last_crawled_at": stmt.excluded.last_crawled_at},
+    )
+    session.exec(stmt)
+
+
+def mark_crawled(session: Session, entries: list[CrawlQueueEntry]):
+    session.exec(
+        text(
+            """
+            UPDATE crawl_queue
+            SET last_crawled_at = :now, leased_until = NULL, attempts = 0, last_error = NULL
+            WHERE id = ANY(:ids)
+            """
+        ).bindparams(now=utcnow(), ids=[entry.id for entry in entries])
+    )
+    session.commit()
+
+
+def mark_deferred(
+    session: Session, entries: list[CrawlQueueEntry], until: datetime, reason: str
+):
+    """
+    Keeps `entries` leased until `until` without counting a failed attempt, for
+    work that couldn't be done for reasons unrelated to the titles themselves.
+    """
+    session.exec(
+        text(
+            """
+            UPDATE crawl_queue
+            SET leased_until = :until, attempts = GREATEST(attempts - 1, 0), last_error = :reason
+            WHERE id = ANY(:ids)
+            """
+        ).bindparams(until=until, reason=reason, ids=[entry.id for entry in entries])
+    )
+    session.commit()
+
+
+def mark_failed(session: Session, entry: CrawlQueueEntry, error: BaseException):
+    # Back off exponentially by keeping the lease for longer after each failure
+    backoff = LEASE_DURATION * 2 ** min(entry.attempts, 6)
+    session.exec(
+        text(
+            """
+            UPDATE crawl_queue
+            SET leased_until = :leased_until, last_error = :error
+            WHERE id = :id
+            """
+        ).bindparams(leased_until=utcnow() + backoff, error=repr(error), id=entry.id)
+    )
+    session.commit()
@@ -0,0 +1,24 @@
+import os
+from typing import Annotated
+
+from fastapi import Depends
+from sqlmodel import Session, create_engine
+
+POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
+POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
+POSTGRES_PORT = os.getenv("POSTGRES_PORT", 5432)
+POSTGRES_DB = os.getenv("POSTGRES_DB", "postgres")
+DATABASE_URL = f"postgresql+psycopg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# For talking to psycopg directly, e.g. for LISTEN/NOTIFY
+PSYCOPG_CONNINFO = DATABASE_URL.replace("postgresql+psycopg://", "postgresql://")
+
+engine = create_engine(DATABASE_URL, echo=True)
+
+
+def get_session():
+    with Session(engine) as session:
+        yield session
+
+
+DatabaseSessionDep = Annotated[Session, Depends(get_session)]
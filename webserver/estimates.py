@@ -0,0 +1,167 @@
+import os
+import time
+from typing import Any, Optional
+from dataclasses import dataclass
+
+import numpy as np
+from sqlmodel import Session
+from sqlalchemy import text
+
+TARGET_VENDOR = "Google users"
+SOURCE_VENDORS = ("IMDb", "Rotten Tomatoes")
+
+# How often the model is refit from the ratings table
+ESTIMATE_REFIT_SECONDS = float(os.getenv("ESTIMATE_REFIT_SECONDS", 3600))
+
+# An estimate is flagged confident when its expected error (RMSE, in rating
+# points) is at most this
+ESTIMATE_CONFIDENT_RMSE = float(os.getenv("ESTIMATE_CONFIDENT_RMSE", 5))
+
+# Vendors with fewer titles rated by both them and Google users aren't used
+ESTIMATE_MIN_PAIRS = int(os.getenv("ESTIMATE_MIN_PAIRS", 200))
+
+# Whether streaming jobs skip the SERP lookup for titles whose stored ratings
+# already give a confident estimate
+ESTIMATE_SKIP_SERP = os.getenv("ESTIMATE_SKIP_SERP", "1") == "1"
+
+# Points of the quantile mapping between a vendor's scale and Google users'
+QUANTILE_LEVELS = np.linspace(0, 1, 101)
+
+
+@dataclass(frozen=True)
+class VendorMapping:
+    source_quantiles: np.ndarray
+    target_quantiles: np.ndarray
+    rmse: float
+    pairs: int
+
+    def apply(self, ratings: np.ndarray) -> np.ndarray:
+        return np.interp(ratings, self.source_quantiles, self.target_quantiles)
+
+
+@dataclass(frozen=True)
+class Estimate:
+    rating: int
+    confident: bool
+
+
+def load_ratings_matrix(session: Session) -> np.ndarray:
+    """One row per title, one column per vendor (TARGET_VENDOR first), NaN where missing."""
+    vendors = (TARGET_VENDOR, *SOURCE_VENDORS)
+    rows = session.exec(
+        text(
+            """
+            SELECT netflix_id, vendor, rating
+            FROM ratings
+            WHERE vendor = ANY(:vendors) AND rating > 0
+            """
+        ).bindparams(vendors=list(vendors))
+    ).all()
+    if not rows:
+        return np.empty((0, len(vendors)))
+
+    netflix_ids, vendor_names, ratings = zip(*rows)
+    _, title_index = np.unique(np.array(netflix_ids), return_inverse=True)
+    vendor_index = (np.array(vendor_names)[:, None] == np.array(vendors)).argmax(axis=1)
+
+    matrix = np.full((title_index.max() + 1, len(vendors)), np.nan)
+    matrix[title_index, vendor_index] = np.array(ratings, dtype=float)
+    return matrix
+
+
+def load_vendor_ratings(
+    session: Session, netflix_ids: list[int]
+) -> dict[int, dict[str, int]]:
+    """The stored ratings the estimator uses, per title: {netflix_id: {vendor: rating}}."""
+    rows = session.exec(
+        text(
+            """
+            SELECT netflix_id, vendor, rating
+            FROM ratings
+            WHERE netflix_id = ANY(:netflix_ids) AND vendor = ANY(:vendors) AND rating > 0
+            """
+        ).bindparams(
+            netflix_ids=list(netflix_ids), vendors=[TARGET_VENDOR, *SOURCE_VENDORS]
+        )
+    ).all()
+    ratings = {}
+    for netflix_id, vendor, rating in rows:
+        ratings.setdefault(netflix_id, {})[vendor] = rating
+    return ratings
+
+
+def fit_mapping(source: np.ndarray, target: np.ndarray) -> VendorMapping:
+    """
+    Quantile mapping: a source rating at the p-th percentile of the source vendor's
+    distribution maps to the p-th percentile of Google users' ratings, over the
+    titles both rated. Monotone, so it keeps the vendor's ordering of titles.
+    """
+    source_quantiles = np.quantile(source, QUANTILE_LEVELS)
+    target_quantiles = np.quantile(target, QUANTILE_LEVELS)
+    residuals = np.interp(source, source_quantiles, target_quantiles) - target
+    return VendorMapping(
+        source_quantiles,
+        target_quantiles,
+        rmse=float(np.sqrt(np.mean(residuals**2))),
+        pairs=len(source),
+    )
+
+
+class RatingEstimator:
+    """
+    Estimates a title's Google users rating from its other vendors' ratings.
+
+    Each vendor's estimate is weighted by the inverse of its squared error. The
+    vendors' errors are correlated, so combining them isn't credited with a lower
+    error: the confidence flag goes by the best vendor present.
+
+    `fit` builds a whole new set of mappings and swaps it in, so readers never
+    see a half-fitted model.
+    """
+
+    def __init__(self):
+        self._mappings: dict[str, VendorMapping] = {}
+        self.fitted_at: Optional[float] = None
+
+    def fit(self, session: Session):
+        matrix = load_ratings_matrix(session)
+        target = matrix[:, 0]
+        mappings = {}
+        for column, vendor in enumerate(SOURCE_VENDORS, start=1):
+            both = ~np.isnan(matrix[:, column]) & ~np.isnan(target)
+            if both.sum() >= ESTIMATE_MIN_PAIRS:
+                mappings[vendor] = fit_mapping(matrix[both, column], target[both])
+
+        self._mappings = mappings
+        self.fitted_at = time.time()
+
+    def estimate(self, ratings: dict[str, int]) -> Optional[Estimate]:
+        """`ratings` maps vendor to rating; returns None when no usable vendor is present."""
+        mappings = self._mappings
+        used = [
+            (mapping, rating)
+            for vendor, mapping in mappings.items()
+            if (rating := ratings.get(vendor))
+        ]
+        if not used:
+            return None
+
+        rmses = np.array([mapping.rmse for mapping, _ in used])
+        estimates = [float(mapping.apply(rating)) for mapping, rating in used]
+        rating = np.average(estimates, weights=1 / np.maximum(rmses, 1e-6) ** 2)
+        return Estimate(
+            rating=round(float(rating)),
+            confident=bool(rmses.min() <= ESTIMATE_CONFIDENT_RMSE),
+        )
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "fitted_at": self.fitted_at,
+            "vendors": {
+                vendor: {"pairs": mapping.pairs, "rmse": mapping.rmse}
+                for vendor, mapping in self._mappings.items()
+            },
+        }
+
+
+rating_estimator = RatingEstimator()
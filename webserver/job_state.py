@@ -0,0 +1,203 @@
+import os
+import socket
+from uuid import UUID
+from typing import Optional, AsyncIterator
+
+import psycopg
+from models import Job
+from sqlmodel import Session
+from sqlalchemy import text
+
+NOTIFY_CHANNEL = "job_results"
+
+# A running job whose executor hasn't published anything for this long is presumed dead
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", 120))
+
+# How often the worker executing a job refreshes its heartbeat
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", JOB_STALE_SECONDS / 4))
+
+# How long a relay waits for a notification before sending an SSE keep-alive comment
+RELAY_KEEPALIVE_SECONDS = float(os.getenv("RELAY_KEEPALIVE_SECONDS", 15))
+
+# How long finished jobs (and their results) are kept around for late subscribers
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", 24))
+
+FINISHED_STATUSES = ("done", "incomplete")
+
+
+class PostgresJobStore:
+    """
+    Job state shared by every webserver worker.
+
+    The worker that claims a job executes it and `publish`es each SSE message
+    into `job_results`, announcing it with NOTIFY. Any other worker asked to
+    stream the same job `relay`s those messages: it replays what's already
+    stored, then LISTENs for the rest until the job finishes.
+    """
+
+    def __init__(self, conninfo: str):
+        self.conninfo = conninfo
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def create(self, session: Session, payload: list[int], country: str) -> Job:
+        job = Job(payload=payload, country=country)
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+        return job
+
+    def get(self, session: Session, job_id: UUID) -> Optional[Job]:
+        return session.get(Job, job_id)
+
+    def claim(self, session: Session, job_id: UUID) -> Optional[Job]:
+        """Takes ownership of a job nobody is executing; returns None if that's not possible."""
+        row = session.exec(
+            text(
+                """
+                UPDATE jobs
+                SET status = 'running', owner = :owner, heartbeat_at = timezone('utc', now())
+                WHERE id = :id
+                    AND (
+                        status = 'pending'
+                        OR (
+                            status = 'running'
+                            AND heartbeat_at < timezone('utc', now()) - make_interval(secs => :stale)
+                            AND NOT EXISTS (SELECT 1 FROM job_results WHERE job_id = :id)
+                        )
+                    )
+                RETURNING *
+                """
+            ).bindparams(id=job_id, owner=self.owner, stale=JOB_STALE_SECONDS)
+        ).first()
+        session.commit()
+        return Job.model_validate(row._mapping) if row else None
+
+    def heartbeat(self, session: Session, job_id: UUID):
+        """Tells other workers the job's executor is alive, published results or not."""
+        session.exec(
+            text(
+                "UPDATE jobs SET heartbeat_at = timezone('utc', now()) WHERE id = :id"
+            ).bindparams(id=job_id)
+        )
+        session.commit()
+
+    def publish(self, session: Session, job_id: UUID, seq: int, message: str):
+        params = {"id": job_id, "seq": seq, "message": message}
+        session.exec(
+            text(
+                "INSERT INTO job_results (job_id, seq, message) VALUES (:id, :seq, :message)"
+            ).bindparams(**params)
+        )
+        session.exec(
+            text(
+                "UPDATE jobs SET heartbeat_at = timezone('utc', now()) WHERE id = :id"
+            ).bindparams(id=job_id)
+        )
+        # Delivered to listeners when the transaction commits
+        session.exec(
+            text("SELECT pg_notify(:channel, :id)").bindparams(
+                channel=NOTIFY_CHANNEL, id=str(job_id)
+            )
+        )
+        session.commit()
+
+    def finish(
+        self,
+        session: Session,
+        job_id: UUID,
+        complete: bool,
+        serp_requests: int = 0,
+        serp_blocked: int = 0,
+    ):
+        session.exec(
+            text(
+                """
+                UPDATE jobs
+                SET
+                    status = :status,
+                    finished_at = timezone('utc', now()),
+                    serp_requests = :serp_requests,
+                    serp_blocked = :serp_blocked
+                WHERE id = :id
+                """
+            ).bindparams(
+                id=job_id,
+                status="done" if complete else "incomplete",
+                serp_requests=serp_requests,
+                serp_blocked=serp_blocked,
+            )
+        )
+        session.exec(
+            text("SELECT pg_notify(:channel, :id)").bindparams(
+                channel=NOTIFY_CHANNEL, id=str(job_id)
+            )
+        )
+        session.commit()
+
+    def prune(self, session: Session) -> int:
+        """
+        Deletes finished jobs past their retention. Unfinished jobs are only deleted
+        once their executor has been silent for that long too, i.e. it's long dead.
+        """
+        result = session.exec(
+            text(
+                """
+                DELETE FROM jobs
+                WHERE created_at < timezone('utc', now()) - make_interval(hours => :hours)
+                    AND (
+                        status = ANY(:finished)
+                        OR COALESCE(heartbeat_at, created_at)
+                            < timezone('utc', now()) - make_interval(hours => :hours)
+                    )
+                """
+            ).bindparams(hours=JOB_RETENTION_HOURS, finished=list(FINISHED_STATUSES))
+        )
+        session.commit()
+        return result.rowcount
+
+    async def relay(self, job_id: UUID) -> AsyncIterator[str]:
+        """Yields the SSE messages of a job executed by another worker."""
+        async with await psycopg.AsyncConnection.connect(
+            self.conninfo, autocommit=True
+        ) as conn:
+            await conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            last_seq = -1
+
+            while True:
+                # Read the status before the results: a job is only marked finished
+                # after its last result is committed, so nothing can be missed
+                cursor = await conn.execute(
+                    """
+                    SELECT
+                        status,
+                        heartbeat_at < timezone('utc', now()) - make_interval(secs => %s)
+                    FROM jobs
+                    WHERE id = %s
+                    """,
+                    (JOB_STALE_SECONDS, job_id),
+                )
+                row = await cursor.fetchone()
+                if row is None:
+                    # Pruned, along with its results
+                    return
+                status, stale = row
+
+                cursor = await conn.execute(
+                    "SELECT seq, message FROM job_results WHERE job_id = %s AND seq > %s ORDER BY seq",
+                    (job_id, last_seq),
+                )
+                for seq, message in await cursor.fetchall():
+                    last_seq = seq
+                    yield f"data: {message}" + "\n\n"
+
+                if status in FINISHED_STATUSES or stale:
+                    return
+
+                notified = False
+                async for notify in conn.notifies(timeout=RELAY_KEEPALIVE_SECONDS):
+                    if notify.payload == str(job_id):
+                        notified = True
+                        break
+
+                if not notified:
+                    yield ": keep-alive\n\n"
@@ -2,14 +2,18 @@
 # the contents of the model classes were largely autogenerated by the command
 # `sqlacodegen --generator sqlmodels postgresql://localhost:5432/postgres`
 
-from typing import List, ClassVar, Optional
+import itertools
+from uuid import UUID, uuid4
+from typing import List, Iterable, ClassVar, Optional
 from datetime import datetime, timezone
 
 from pydantic import Json
-from sqlmodel import Field, SQLModel, Relationship
+from psycopg.types.json import Jsonb
+from sqlmodel import Field, Session, SQLModel, Relationship
 from sqlalchemy import (
     CHAR,
     Enum,
+    Uuid,
     Text,
     String,
     Boolean,
@@ -20,9 +24,13 @@ from sqlalchemy import (
     UniqueConstraint,
     ForeignKeyConstraint,
     PrimaryKeyConstraint,
+    table,
+    column,
+    select,
 )
+from sqlalchemy import inspect as sa_inspect
 from sqlalchemy.schema import Column
-from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert
 
 
 class BaseModel(SQLModel):
@@ -35,6 +43,10 @@ class BaseModel(SQLModel):
     # UPSERT statement
     UPSERT_EXCLUDE_FIELDS: ClassVar[set[str]] = set()
 
+    # Specifies how many rows `bulk_upsert` streams into the staging table
+    # before merging them into the target table
+    UPSERT_CHUNK_SIZE: ClassVar[int] = 10_000
+
     @property
     def primary_key(self):
         return [k for k, v in self.model_fields.items() if v.primary_key][0]
@@ -69,6 +81,97 @@ class BaseModel(SQLModel):
 
         return insert(cls).values(insertables).on_conflict_do_nothing()
 
+    @classmethod
+    def bulk_upsert(
+        cls,
+        session: Session,
+        model_instances: Iterable[SQLModel],
+        chunk_size: Optional[int] = None,
+    ) -> int:
+        """
+        Upserts `model_instances` by streaming them via COPY into a temporary
+        staging table, `chunk_size` rows at a time, and merging each chunk into
+        the model's table with a single INSERT ... SELECT ... ON CONFLICT DO UPDATE
+        honoring `UPSERT_INDEX_ELEMENTS` and `UPSERT_EXCLUDE_FIELDS`.
+
+        Unlike `bulk_insert_ignore_conflicts` existing rows are updated, and unlike
+        `upsert` the number of statements doesn't grow with the number of objects.
+        Executes against (but does not commit) `session`; returns the number of rows sent.
+        """
+        if not cls.UPSERT_INDEX_ELEMENTS:
+            raise ValueError(f"{cls.__name__} doesn't define UPSERT_INDEX_ELEMENTS")
+
+        chunk_size = chunk_size or cls.UPSERT_CHUNK_SIZE
+        target = cls.__table__
+
+        # Map model attribute names to their columns, which needn't share a name
+        columns = {
+            attr.key: attr.columns[0]
+            for attr in sa_inspect(cls).column_attrs
+            if not attr.columns[0].primary_key
+        }
+        column_names = [col.name for col in columns.values()]
+        jsonb_columns = {
+            col.name for col in columns.values() if isinstance(col.type, JSONB)
+        }
+
+        # ON CONFLICT DO UPDATE can't touch the same row twice in one statement,
+        # so only the last occurrence of each conflict target is kept
+        rows = {}
+        for obj in model_instances:
+            if not isinstance(obj, cls):
+                raise ValueError("Can only bulk upsert into one model at a time")
+            dumped = obj.model_dump(exclude={obj.primary_key})
+            row = {columns[key].name: value for key, value in dumped.items()}
+            for name in jsonb_columns:
+                if row[name] is not None:
+                    row[name] = Jsonb(row[name])
+            key = tuple(row[name] for name in sorted(cls.UPSERT_INDEX_ELEMENTS))
+            rows.pop(key, None)
+            rows[key] = [row[name] for name in column_names]
+
+        if not rows:
+            return 0
+
+        connection = session.connection()
+        quote = connection.dialect.identifier_preparer.quote
+        staging_name = f"staging_{target.name}"
+        quoted_columns = ", ".join(quote(name) for name in column_names)
+
+        # A column-only copy of the target: no constraints, defaults or indexes to maintain
+        connection.exec_driver_sql(
+            f"CREATE TEMPORARY TABLE IF NOT EXISTS {quote(staging_name)} ON COMMIT DROP "
+            f"AS SELECT {quoted_columns} FROM {quote(target.name)} WITH NO DATA"
+        )
+
+        staging = table(staging_name, *[column(name) for name in column_names])
+        stmt = insert(target).from_select(column_names, select(*staging.c))
+        to_update = {
+            name: stmt.excluded[name]
+            for name in column_names
+            if name not in cls.UPSERT_INDEX_ELEMENTS
+            and name not in cls.UPSERT_EXCLUDE_FIELDS
+        }
+        if to_update:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=cls.UPSERT_INDEX_ELEMENTS, set_=to_update
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=cls.UPSERT_INDEX_ELEMENTS)
+
+        driver_connection = connection.connection.driver_connection
+        for chunk in itertools.batched(rows.values(), chunk_size):
+            with driver_connection.cursor() as cursor:
+                with cursor.copy(
+                    f"COPY {quote(staging_name)} ({quoted_columns}) FROM STDIN"
+                ) as copy:
+                    for row in chunk:
+                        copy.write_row(row)
+            connection.execute(stmt)
+            connection.exec_driver_sql(f"TRUNCATE {quote(staging_name)}")
+
+        return len(rows)
+
 
 class Title(BaseModel, table=True):
     __tablename__ = "titles"
@@ -77,6 +180,8 @@ class Title(BaseModel, table=True):
         UniqueConstraint("netflix_id", name="netflix_id"),
     )
 
+    UPSERT_INDEX_ELEMENTS: ClassVar[set[str]] = {"netflix_id"}
+
     id: Optional[int] = Field(
         default=None, sa_column=Column("id", Integer, primary_key=True)
     )
@@ -92,10 +197,42 @@ class Title(BaseModel, table=True):
         default=None, sa_column=Column("release_year", Integer)
     )
     runtime: Optional[int] = Field(default=None, sa_column=Column("runtime", Integer))
-    meta_data: Optional[Json] = Field(default=None, sa_column=Column("metadata", JSONB))
 
     availability: List["Availability"] = Relationship(back_populates="title")
     ratings: List["Rating"] = Relationship(back_populates="title")
+    # Lives in its own table so the bulky blob stays out of scans of `titles`;
+    # only loaded when accessed
+    title_metadata: Optional["TitleMetadata"] = Relationship(
+        back_populates="title", sa_relationship_kwargs={"uselist": False}
+    )
+
+
+class TitleMetadata(BaseModel, table=True):
+    """The full react context parsed from a title page (see `common.get_field`)."""
+
+    __tablename__ = "title_metadata"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["netflix_id"],
+            ["titles.netflix_id"],
+            name="title_metadata_netflix_id_fkey",
+            ondelete="CASCADE",
+        ),
+        PrimaryKeyConstraint("id", name="title_metadata_pkey"),
+        UniqueConstraint("netflix_id", name="title_metadata_netflix_id_key"),
+    )
+
+    UPSERT_INDEX_ELEMENTS: ClassVar[set[str]] = {"netflix_id"}
+
+    id: Optional[int] = Field(
+        default=None, sa_column=Column("id", Integer, primary_key=True)
+    )
+    netflix_id: int = Field(default=None, sa_column=Column("netflix_id", BigInteger))
+    react_context: Optional[Json] = Field(
+        default=None, sa_column=Column("react_context", JSONB)
+    )
+
+    title: Title = Relationship(back_populates="title_metadata")
 
 
 class Availability(BaseModel, table=True):
@@ -107,6 +244,8 @@ class Availability(BaseModel, table=True):
         UniqueConstraint("country", "netflix_id", name="unique_country_and_netflix_id"),
     )
 
+    UPSERT_INDEX_ELEMENTS: ClassVar[set[str]] = {"country", "netflix_id"}
+
     id: Optional[int] = Field(
         default=None, sa_column=Column("id", Integer, primary_key=True)
     )
@@ -122,7 +261,8 @@ class Availability(BaseModel, table=True):
         default=None, sa_column=Column("available", Boolean)
     )
     checked_at: Optional[datetime] = Field(
-        default=datetime.now(timezone.utc), sa_column=Column("checked_at", DateTime)
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column=Column("checked_at", DateTime),
     )
 
     title: Title = Relationship(back_populates="availability")
@@ -138,6 +278,8 @@ class Rating(BaseModel, table=True):
         UniqueConstraint("vendor", "netflix_id", name="unique_vendor_and_netflix_id"),
     )
 
+    UPSERT_INDEX_ELEMENTS: ClassVar[set[str]] = {"vendor", "netflix_id"}
+
     id: Optional[int] = Field(
         default=None, sa_column=Column("id", Integer, primary_key=True)
     )
@@ -149,7 +291,99 @@ class Rating(BaseModel, table=True):
         default=None, sa_column=Column("ratings_count", Integer)
     )
     checked_at: Optional[datetime] = Field(
-        default=datetime.now(timezone.utc), sa_column=Column("checked_at", DateTime)
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column=Column("checked_at", DateTime),
     )
 
     title: Title = Relationship(back_populates="ratings")
+
+
+class CrawlQueueEntry(BaseModel, table=True):
+    __tablename__ = "crawl_queue"
+    __table_args__ = (
+        PrimaryKeyConstraint("id", name="crawl_queue_pkey"),
+        UniqueConstraint(
+            "country", "netflix_id", name="crawl_queue_unique_country_and_netflix_id"
+        ),
+    )
+
+    UPSERT_INDEX_ELEMENTS: ClassVar[set[str]] = {"country", "netflix_id"}
+
+    id: Optional[int] = Field(
+        default=None, sa_column=Column("id", Integer, primary_key=True)
+    )
+    netflix_id: int = Field(default=None, sa_column=Column("netflix_id", BigInteger))
+    country: str = Field(default=None, sa_column=Column("country", CHAR(2)))
+    request_count: int = Field(
+        default=0, sa_column=Column("request_count", Integer, nullable=False)
+    )
+    last_requested_at: Optional[datetime] = Field(
+        default=None, sa_column=Column("last_requested_at", DateTime)
+    )
+    last_crawled_at: Optional[datetime] = Field(
+        default=None, sa_column=Column("last_crawled_at", DateTime)
+    )
+    leased_until: Optional[datetime] = Field(
+        default=None, sa_column=Column("leased_until", DateTime)
+    )
+    attempts: int = Field(
+        default=0, sa_column=Column("attempts", SmallInteger, nullable=False)
+    )
+    last_error: Optional[str] = Field(
+        default=None, sa_column=Column("last_error", Text)
+    )
+    # Set on entries added by the prefetcher (see prefetch.py)
+    prefetch_depth: Optional[int] = Field(
+        default=None, sa_column=Column("prefetch_depth", SmallInteger)
+    )
+    prefetched_at: Optional[datetime] = Field(
+        default=None, sa_column=Column("prefetched_at", DateTime)
+    )
+    prefetch_hit_at: Optional[datetime] = Field(
+        default=None, sa_column=Column("prefetch_hit_at", DateTime)
+    )
+
+
+class Job(BaseModel, table=True):
+    __tablename__ = "jobs"
+    __table_args__ = (PrimaryKeyConstraint("id", name="jobs_pkey"),)
+
+    id: UUID = Field(
+        default_factory=uuid4, sa_column=Column("id", Uuid, primary_key=True)
+    )
+    country: str = Field(default=None, sa_column=Column("country", CHAR(2)))
+    payload: List[int] = Field(
+        default_factory=list, sa_column=Column("payload", ARRAY(BigInteger))
+    )
+    status: str = Field(default="pending", sa_column=Column("status", String(16)))
+    owner: Optional[str] = Field(default=None, sa_column=Column("owner", Text))
+    heartbeat_at: Optional[datetime] = Field(
+        default=None, sa_column=Column("heartbeat_at", DateTime)
+    )
+    created_at: Optional[datetime] = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column=Column("created_at", DateTime),
+    )
+    finished_at: Optional[datetime] = Field(
+        default=None, sa_column=Column("finished_at", DateTime)
+    )
+    serp_requests: int = Field(
+        default=0, sa_column=Column("serp_requests", Integer, nullable=False)
+    )
+    serp_blocked: int = Field(
+        default=0, sa_column=Column("serp_blocked", Integer, nullable=False)
+    )
+
+
+class JobResult(BaseModel, table=True):
+    __tablename__ = "job_results"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["job_id"], ["jobs.id"], name="job_results_job_id_fkey", ondelete="CASCADE"
+        ),
+        PrimaryKeyConstraint("job_id", "seq", name="job_results_pkey"),
+    )
+
+    job_id: UUID = Field(sa_column=Column("job_id", Uuid, primary_key=True))
+    seq: int = Field(sa_column=Column("seq", Integer, primary_key=True))
+    message: str = Field(sa_column=Column("message", Text))
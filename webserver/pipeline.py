@@ -0,0 +1,460 @@
+import os
+import asyncio
+import itertools
+import multiprocessing
+from typing import Any, Callable, Iterable, Optional, Container
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import aiohttp
+import app_logger
+from common import (
+    HTMLContent,
+    NetflixSessionHandler,
+    ContextExtractionError,
+    BrightDataSessionHandler,
+    get_field,
+    get_serp_html,
+    configure_logger,
+    save_response_body,
+    extract_netflix_react_context,
+)
+from models import Title, Rating, Availability, TitleMetadata
+from aliases import parse_netflix_id
+from budget import SerpBudget, SerpBudgetExhausted
+from crawl_queue import record_crawled
+from stages import Stage, StagedPipeline
+from fastapi import BackgroundTasks
+from sqlmodel import Session
+
+THIS_DIR = Path(__file__).parent
+ROOT_DIR = THIS_DIR.parent
+DOWNLOADED_TITLEPAGES_DIR = ROOT_DIR / "data" / "raw" / "title"  # TODO
+DOWNLOADED_SERP_PAGES_DIR = ROOT_DIR / "data" / "raw" / "serp"  # TODO
+
+# Per-stage concurrency and queue capacity of `build_title_pipeline`. Parsing
+# concurrency is also the number of parser processes (see `parse_off_loop`)
+FETCH_CONCURRENCY = int(os.getenv("PIPELINE_FETCH_CONCURRENCY", 5))
+PARSE_CONCURRENCY = int(os.getenv("PIPELINE_PARSE_CONCURRENCY", 1))
+SERP_CONCURRENCY = int(os.getenv("PIPELINE_SERP_CONCURRENCY", 5))
+STAGE_CAPACITY = int(os.getenv("PIPELINE_STAGE_CAPACITY", 10))
+
+
+formatter = app_logger.CustomJSONFormatter("%(asctime)s")
+logger = app_logger.get_logger(
+    __name__, formatter, fileout=(THIS_DIR / "logs" / f"{Path(__file__).stem}.log")
+)
+configure_logger(logger)
+
+
+def get_redirect_target(
+    title_id: int, response: aiohttp.ClientResponse
+) -> Optional[int]:
+    """Returns the ID a title page redirected to, whether or not aiohttp followed the redirect."""
+    if response.status in (301, 302):
+        redirected_netflix_id = parse_netflix_id(response.headers.get("Location"))
+    elif response.history:
+        redirected_netflix_id = parse_netflix_id(response.url.path)
+    else:
+        redirected_netflix_id = None
+
+    if redirected_netflix_id == title_id:
+        return None
+    return redirected_netflix_id
+
+
+async def fetch_title_page(
+    title_id: int,
+    session_handler: NetflixSessionHandler,
+    background_tasks: BackgroundTasks,
+) -> tuple[Optional[HTMLContent], Optional[int]]:
+    """Returns the title page's HTML (None on timeout) and the ID it redirected to, if any."""
+    request_path = f"title/{title_id}"
+    redirected_netflix_id = None
+    async with session_handler.limiter:
+        try:
+            async with session_handler.noauth_session.get(request_path) as response:
+                logger.info(f"Starting request for {request_path}")
+                if response.status not in (200, 301, 302, 404):
+                    response.raise_for_status()
+
+                redirected_netflix_id = get_redirect_target(title_id, response)
+                if redirected_netflix_id is not None:
+                    logger.info(f"{request_path} redirected to {redirected_netflix_id}")
+
+                html_content = HTMLContent(await response.text())
+
+                background_tasks.add_task(
+                    save_response_body,
+                    html_content,
+                    DOWNLOADED_TITLEPAGES_DIR / f"{title_id}.html",
+                )
+
+                return html_content, redirected_netflix_id
+
+        except aiohttp.ConnectionTimeoutError as e:
+            logger.exception(e)
+            return None, redirected_netflix_id
+
+
+def parse_title_page(html_content: Optional[HTMLContent]) -> list[dict]:
+    if html_content is None:
+        return []
+    try:
+        return extract_netflix_react_context(html_content)
+    except ContextExtractionError as e:
+        logger.exception(e)
+        return []
+
+
+_parse_executor: Optional[ProcessPoolExecutor] = None
+
+
+async def parse_off_loop(html_content: Optional[HTMLContent]) -> list[dict]:
+    """
+    `parse_title_page` in a pool of PARSE_CONCURRENCY processes. Running PythonMonkey
+    is CPU-bound, so it can't share the event loop with the other stages, and it
+    can't go to a thread pool either: its JS context belongs to the thread that
+    created it. Each process has a context of its own, in its main thread.
+    """
+    global _parse_executor
+    if _parse_executor is None:
+        # Not forked: the parent has threads and possibly a JS context of its own
+        _parse_executor = ProcessPoolExecutor(
+            max_workers=PARSE_CONCURRENCY,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    executor = _parse_executor
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, parse_title_page, html_content
+        )
+    except BrokenProcessPool:
+        # A parser process died; start a fresh pool for the next title
+        if _parse_executor is executor:
+            _parse_executor = None
+        raise
+
+
+def shutdown_parse_executor():
+    global _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown(cancel_futures=True)
+        _parse_executor = None
+
+
+async def fetch_and_process_title(
+    title_id: int,
+    session_handler: NetflixSessionHandler,
+    background_tasks: BackgroundTasks,
+) -> tuple[list[dict], Optional[int]]:
+    """Returns the title page's react context and the ID it redirected to, if any."""
+    html_content, redirected_netflix_id = await fetch_title_page(
+        title_id, session_handler, background_tasks
+    )
+    return parse_title_page(html_content), redirected_netflix_id
+
+
+async def scrape_serp_for_ratings(
+    netflix_id,
+    title_data,
+    brd_session_handler: BrightDataSessionHandler,
+    background_tasks: BackgroundTasks,
+    budget: Optional[SerpBudget] = None,
+) -> list[dict]:
+    """Raises `SerpBudgetExhausted` if `budget` doesn't allow the request."""
+    async with brd_session_handler.limiter:
+        logger.info(f"Attempting to get SERP reviews for {netflix_id}")
+        if not title_data:
+            return []
+        if budget is not None and not await budget.try_spend():
+            logger.warning(f"SERP budget exhausted, skipping {netflix_id}")
+            raise SerpBudgetExhausted(netflix_id)
+        serp_response = await get_serp_html(
+            netflix_id,
+            get_field(title_data, "title"),
+            get_field(title_data, "content_type"),
+            get_field(title_data, "release_year"),
+            session=brd_session_handler.choose_session(),
+        )
+        background_tasks.add_task(
+            save_response_body,
+            serp_response.html,
+            DOWNLOADED_SERP_PAGES_DIR / f"{netflix_id}.html",
+        )
+        return [rating.__dict__ for rating in serp_response.ratings]
+
+
+async def download_title_and_lookup_ratings(
+    title_id,
+    nflx_session_handler: NetflixSessionHandler,
+    brd_session_handler: BrightDataSessionHandler,
+    background_tasks: BackgroundTasks,
+    budget: Optional[SerpBudget] = None,
+) -> dict[str, Any]:
+    """
+    The result's `serp_blocked` is set when the budget blocked the SERP request,
+    as opposed to the request finding no ratings.
+    """
+    title_data, redirected_netflix_id = await fetch_and_process_title(
+        title_id,
+        nflx_session_handler,
+        background_tasks,
+    )
+    result = {
+        "netflix_id": title_id,
+        "redirected_netflix_id": redirected_netflix_id,
+        "react_context": title_data,
+        "ratings": [],
+        "serp_blocked": False,
+    }
+    try:
+        result["ratings"] = await scrape_serp_for_ratings(
+            title_id, title_data, brd_session_handler, background_tasks, budget
+        )
+    except SerpBudgetExhausted:
+        result["serp_blocked"] = True
+    return result
+
+
+def build_title_pipeline(
+    nflx_session_handler: NetflixSessionHandler,
+    brd_session_handler: BrightDataSessionHandler,
+    background_tasks: BackgroundTasks,
+    budget: Optional[SerpBudget] = None,
+    skip_serp: Container[int] = (),
+    lookup_canonical: Optional[Callable[[int], Optional[Any]]] = None,
+) -> StagedPipeline:
+    """
+    The staged equivalent of `download_title_and_lookup_ratings`: title IDs go in,
+    the same result dicts come out, but only a bounded number are in flight at once.
+    Titles in `skip_serp` come out with no ratings instead of costing a SERP request.
+
+    A title that turns out to redirect is looked up with the blocking
+    `lookup_canonical(redirected_netflix_id)`. If that returns the stored answer
+    for the canonical title, it comes out as the result's "canonical" instead of
+    costing a SERP request.
+
+    The SERP response is fetched and parsed by a single call to `get_serp_html`,
+    so those two share a stage. A title failing in any stage comes out like one
+    whose page couldn't be parsed, so every title gets a result.
+    """
+
+    def failed(item: Any, error: Exception) -> dict[str, Any]:
+        # Items are title IDs going into the first stage, result dicts after that
+        if isinstance(item, int):
+            item = {"netflix_id": item, "redirected_netflix_id": None}
+        return {
+            "netflix_id": item["netflix_id"],
+            "redirected_netflix_id": item["redirected_netflix_id"],
+            "react_context": [],
+            "ratings": [],
+            "serp_blocked": False,
+        }
+
+    async def fetch(title_id: int) -> dict[str, Any]:
+        html_content, redirected_netflix_id = await fetch_title_page(
+            title_id, nflx_session_handler, background_tasks
+        )
+        return {
+            "netflix_id": title_id,
+            "redirected_netflix_id": redirected_netflix_id,
+            "html": html_content,
+            "serp_blocked": False,
+        }
+
+    async def parse(item: dict[str, Any]) -> dict[str, Any]:
+        item["react_context"] = await parse_off_loop(item.pop("html"))
+        return item
+
+    async def lookup_ratings(item: dict[str, Any]) -> dict[str, Any]:
+        redirected_netflix_id = item["redirected_netflix_id"]
+        if redirected_netflix_id is not None and lookup_canonical is not None:
+            canonical = await asyncio.to_thread(lookup_canonical, redirected_netflix_id)
+            if canonical is not None:
+                logger.info(
+                    f"{item['netflix_id']} redirects to stored title "
+                    f"{redirected_netflix_id}, skipping SERP lookup"
+                )
+                item["canonical"] = canonical
+                item["ratings"] = []
+                # Already stored under the canonical title, no need for a second copy
+                item["react_context"] = []
+                return item
+
+        if item["netflix_id"] in skip_serp:
+            logger.info(f"Skipping SERP lookup for {item['netflix_id']}")
+            item["ratings"] = []
+            return item
+        try:
+            item["ratings"] = await scrape_serp_for_ratings(
+                item["netflix_id"],
+                item["react_context"],
+                brd_session_handler,
+                background_tasks,
+                budget,
+            )
+        except SerpBudgetExhausted:
+            item["ratings"] = []
+            item["serp_blocked"] = True
+        return item
+
+    return StagedPipeline(
+        [
+            Stage(
+                "fetch_title_page",
+                fetch,
+                FETCH_CONCURRENCY,
+                STAGE_CAPACITY,
+                on_error=failed,
+            ),
+            Stage(
+                "parse_title_page",
+                parse,
+                PARSE_CONCURRENCY,
+                STAGE_CAPACITY,
+                on_error=failed,
+            ),
+            Stage(
+                "lookup_ratings",
+                lookup_ratings,
+                SERP_CONCURRENCY,
+                STAGE_CAPACITY,
+                on_error=failed,
+            ),
+        ],
+        output_capacity=STAGE_CAPACITY,
+    )
+
+
+def build_records(
+    result: dict[str, Any], country: str
+) -> tuple[Title, Optional[TitleMetadata], Availability, list[Rating]]:
+    """
+    Turns the output of `download_title_and_lookup_ratings` into model instances.
+    There's no `TitleMetadata` if the title page couldn't be parsed.
+    """
+    netflix_id = result["netflix_id"]
+    title_data = result["react_context"]
+
+    title = Title(
+        netflix_id=netflix_id,
+        title=get_field(title_data, "title"),
+        content_type=get_field(title_data, "content_type"),
+        release_year=get_field(title_data, "release_year"),
+        runtime=get_field(title_data, "runtime"),
+    )
+
+    title_metadata = (
+        TitleMetadata(netflix_id=netflix_id, react_context=title_data)
+        if title_data
+        else None
+    )
+
+    availability = Availability(
+        netflix_id=netflix_id,
+        redirected_netflix_id=result.get("redirected_netflix_id"),
+        country=country,
+        titlepage_reachable=True,
+        available=True,
+    )
+
+    ratings = [
+        Rating(
+            netflix_id=netflix_id,
+            vendor=rating["vendor"],
+            url=rating["url"],
+            rating=rating["rating"],
+            ratings_count=rating["ratings_count"],
+        )
+        for rating in result["ratings"]
+    ]
+
+    return title, title_metadata, availability, ratings
+
+
+def persist_records(
+    db_session: Session,
+    titles: Iterable[Title],
+    title_metadata: Iterable[TitleMetadata],
+    availability: Iterable[Availability],
+    ratings: Iterable[Iterable[Rating]],
+    crawled: Iterable[tuple[int, str]] = (),
+):
+    """
+    Upserts the records built by `build_records` and commits. The `(netflix_id,
+    country)` pairs in `crawled` are marked as freshly crawled in the crawl queue.
+    """
+    title_metadata = list(title_metadata)
+    parsed_ids = {metadata.netflix_id for metadata in title_metadata}
+
+    # A title page that couldn't be parsed shouldn't wipe out a previously parsed title
+    parsed_titles, unparsed_titles = [], []
+    for title in titles:
+        if title.netflix_id in parsed_ids:
+            parsed_titles.append(title)
+        else:
+            unparsed_titles.append(title)
+
+    # Nor should it overwrite a known redirect or the time the title was last checked
+    checked_availability, unchecked_availability = [], []
+    for record in availability:
+        if record.netflix_id in parsed_ids or record.redirected_netflix_id is not None:
+            checked_availability.append(record)
+        else:
+            unchecked_availability.append(record)
+
+    Title.bulk_upsert(db_session, parsed_titles)
+    if unparsed_titles:
+        db_session.exec(Title.bulk_insert_ignore_conflicts(unparsed_titles))
+    TitleMetadata.bulk_upsert(db_session, title_metadata)
+    Availability.bulk_upsert(db_session, checked_availability)
+    if unchecked_availability:
+        db_session.exec(
+            Availability.bulk_insert_ignore_conflicts(unchecked_availability)
+        )
+    Rating.bulk_upsert(db_session, itertools.chain(*ratings))
+    record_crawled(db_session, crawled)
+    db_session.commit()
+
+
+class RecordBuffer:
+    """Collects `build_records` output until it's flushed to the DB."""
+
+    def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        self.titles: list[Title] = []
+        self.title_metadata: list[TitleMetadata] = []
+        self.availability: list[Availability] = []
+        self.ratings: list[list[Rating]] = []
+        self.crawled: list[tuple[int, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def add(self, result: dict[str, Any], country: str) -> Title:
+        title, metadata, availability, ratings = build_records(result, country)
+        self.titles.append(title)
+        if metadata is not None:
+            self.title_metadata.append(metadata)
+        self.availability.append(availability)
+        self.ratings.append(ratings)
+        # Titles still missing their SERP lookup stay due for a refresh
+        if metadata is not None and not result.get("serp_blocked"):
+            self.crawled.append((title.netflix_id, country))
+        return title
+
+    def flush(self, db_session: Session):
+        if self.titles:
+            persist_records(
+                db_session,
+                self.titles,
+                self.title_metadata,
+                self.availability,
+                self.ratings,
+                self.crawled,
+            )
+        self._clear()
@@ -0,0 +1,284 @@
+"""Prefetching of the "more like this" titles listed in title pages' react context."""
+
+import os
+import json
+import argparse
+from typing import Any, Iterable
+from collections import Counter
+
+from models import CrawlQueueEntry
+from database import engine
+from job_state import JOB_STALE_SECONDS
+from crawl_queue import REFRESH_INTERVAL, utcnow
+from sqlmodel import Session
+from sqlalchemy import text
+
+# How many hops from a requested title are prefetched; 0 (the default) disables prefetching
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", 0))
+
+# Most titles prefetched per day, across every worker
+PREFETCH_DAILY_CAP = int(os.getenv("PREFETCH_DAILY_CAP", 500))
+
+# Most related titles queued per processed title
+PREFETCH_MAX_RELATED = int(os.getenv("PREFETCH_MAX_RELATED", 10))
+
+# Sections of the react context listing related titles, either as the key
+# holding them or as the section's "type". Check them against stored pages with
+# `python prefetch.py --check`
+RELATED_SECTIONS = {"moreLikeThis", "similars", "similarVideos", "recommendations"}
+
+# Keys holding a title's ID within those sections. Values may be plain IDs or
+# unified entity IDs like "Video:81234567". A bare "id" is left out on purpose:
+# artwork and sections have those too
+ID_KEYS = {"videoId", "titleId", "unifiedEntityId"}
+
+
+def parse_title_id(value: Any) -> int | None:
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        value = value.rpartition(":")[2]
+        if value.isdigit():
+            return int(value)
+    return None
+
+
+def related_title_ids(
+    react_context: Any, limit: int = PREFETCH_MAX_RELATED
+) -> list[int]:
+    """The IDs of the titles listed in the related sections of a react context, in order."""
+    found = {}
+
+    def walk(node: Any, in_related: bool):
+        if isinstance(node, dict):
+            in_related = in_related or node.get("type") in RELATED_SECTIONS
+            for key, value in node.items():
+                if in_related and key in ID_KEYS:
+                    title_id = parse_title_id(value)
+                    if title_id is not None:
+                        found[title_id] = None
+                elif isinstance(value, (dict, list)):
+                    walk(value, in_related or key in RELATED_SECTIONS)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item, in_related)
+
+    walk(react_context, False)
+    return list(found)[:limit]
+
+
+def _bump_stats(session: Session, **increments: int):
+    columns = ", ".join(increments)
+    values = ", ".join(f":{column}" for column in increments)
+    updates = ", ".join(
+        f"{column} = prefetch_stats.{column} + EXCLUDED.{column}"
+        for column in increments
+    )
+    session.exec(
+        text(
+            f"""
+            INSERT INTO prefetch_stats (day, {columns})
+            VALUES (timezone('utc', now())::date, {values})
+            ON CONFLICT (day) DO UPDATE SET {updates}
+            """
+        ).bindparams(**increments)
+    )
+
+
+def enqueue_related(
+    session: Session, netflix_ids: Iterable[int], country: str, depth: int = 1
+) -> int:
+    """
+    Queues the titles in `netflix_ids` that aren't in the crawl queue yet and
+    have no fresh Google users rating. Returns how many were queued.
+    """
+    netflix_ids = list(netflix_ids)
+    if depth > PREFETCH_DEPTH or not netflix_ids:
+        return 0
+
+    queued = session.exec(
+        text(
+            """
+            INSERT INTO crawl_queue (netflix_id, country, prefetch_depth)
+            SELECT candidate.netflix_id, :country, :depth
+            FROM unnest(CAST(:netflix_ids AS bigint[])) AS candidate (netflix_id)
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM ratings
+                WHERE ratings.netflix_id = candidate.netflix_id
+                    AND ratings.vendor = 'Google users'
+                    AND ratings.checked_at >= :fresh_after
+            )
+            ON CONFLICT (country, netflix_id) DO NOTHING
+            """
+        ).bindparams(
+            country=country,
+            depth=depth,
+            netflix_ids=netflix_ids,
+            fresh_after=utcnow() - REFRESH_INTERVAL,
+        )
+    ).rowcount
+    if queued:
+        _bump_stats(session, enqueued=queued)
+    session.commit()
+    return queued
+
+
+def prefetch_allowance(session: Session) -> int:
+    """
+    How many more titles may be prefetched today; none while any process is
+    running a job, since prefetches would compete with it for the same rate
+    limits. Workers read this before they claim, so concurrent workers can
+    overshoot the cap by up to a batch each.
+    """
+    if PREFETCH_DEPTH <= 0:
+        return 0
+    fetched, jobs_running = session.exec(
+        text(
+            """
+            SELECT
+                (SELECT fetched FROM prefetch_stats WHERE day = timezone('utc', now())::date),
+                EXISTS (
+                    SELECT 1
+                    FROM jobs
+                    WHERE status = 'running'
+                        AND heartbeat_at >= timezone('utc', now()) - make_interval(secs => :stale)
+                )
+            """
+        ).bindparams(stale=JOB_STALE_SECONDS)
+    ).one()
+    if jobs_running:
+        return 0
+    return max(PREFETCH_DAILY_CAP - (fetched or 0), 0)
+
+
+def mark_prefetched(session: Session, entries: list[CrawlQueueEntry]):
+    # Call after `mark_crawled`: the stored data is the prefetcher's for as long
+    # as the two timestamps match, i.e. until anything crawls the title again
+    session.exec(
+        text(
+            "UPDATE crawl_queue SET prefetched_at = last_crawled_at WHERE id = ANY(:ids)"
+        ).bindparams(ids=[entry.id for entry in entries])
+    )
+    _bump_stats(session, fetched=len(entries))
+    session.commit()
+
+
+def record_requests(
+    session: Session, requested: list[int], served: list[int], country: str
+) -> int:
+    """
+    Counts the titles a job asked for, and the ones among `served` (answered from
+    stored data) that the prefetcher had fetched. Returns the number of hits.
+    """
+    hits = 0
+    if served:
+        hits = len(
+            session.exec(
+                text(
+                    """
+                    UPDATE crawl_queue
+                    SET prefetch_hit_at = COALESCE(prefetch_hit_at, :now)
+                    WHERE country = :country
+                        AND netflix_id = ANY(:netflix_ids)
+                        AND prefetched_at = last_crawled_at
+                    RETURNING netflix_id
+                    """
+                ).bindparams(now=utcnow(), country=country, netflix_ids=list(served))
+            ).all()
+        )
+    _bump_stats(session, requests=len(requested), hits=hits)
+    session.commit()
+    return hits
+
+
+def get_prefetch_stats(session: Session) -> dict[str, Any]:
+    requests, hits, fetched = session.exec(
+        text(
+            "SELECT COALESCE(SUM(requests), 0), COALESCE(SUM(hits), 0), COALESCE(SUM(fetched), 0) FROM prefetch_stats"
+        )
+    ).one()
+    used, prefetched = session.exec(
+        text(
+            """
+            SELECT COUNT(prefetch_hit_at), COUNT(prefetched_at)
+            FROM crawl_queue
+            WHERE prefetched_at IS NOT NULL
+            """
+        )
+    ).one()
+    today = session.exec(
+        text(
+            """
+            SELECT enqueued, fetched, requests, hits
+            FROM prefetch_stats
+            WHERE day = timezone('utc', now())::date
+            """
+        )
+    ).first()
+    return {
+        "depth": PREFETCH_DEPTH,
+        "daily_cap": PREFETCH_DAILY_CAP,
+        "today": dict(today._mapping) if today else None,
+        "requests": requests,
+        "hits": hits,
+        # Fraction of requested titles answered with data the prefetcher fetched
+        "hit_rate": hits / requests if requests else None,
+        "fetched": fetched,
+        # Fraction of prefetched titles somebody went on to ask for
+        "precision": used / prefetched if prefetched else None,
+    }
+
+
+def check_stored_contexts(session: Session, limit: int) -> dict[str, Any]:
+    """
+    How many stored react contexts `related_title_ids` finds titles in, and what
+    the contexts hold, to check RELATED_SECTIONS and ID_KEYS against.
+    """
+    section_types = Counter()
+    related_keys = Counter()
+    checked = with_related = 0
+
+    def walk(node: Any, in_related: bool):
+        if isinstance(node, dict):
+            if isinstance(node.get("type"), str):
+                section_types[node["type"]] += 1
+            in_related = in_related or node.get("type") in RELATED_SECTIONS
+            for key, value in node.items():
+                if isinstance(value, (dict, list)):
+                    walk(value, in_related or key in RELATED_SECTIONS)
+                elif in_related:
+                    related_keys[key] += 1
+        elif isinstance(node, list):
+            for item in node:
+                walk(item, in_related)
+
+    rows = session.exec(
+        text(
+            "SELECT react_context FROM title_metadata ORDER BY id DESC LIMIT :limit"
+        ).bindparams(limit=limit)
+    ).scalars()
+    for react_context in rows:
+        checked += 1
+        with_related += bool(related_title_ids(react_context))
+        walk(react_context, False)
+
+    return {
+        "checked": checked,
+        "with_related_titles": with_related,
+        "section_types": section_types.most_common(20),
+        "keys_in_related_sections": related_keys.most_common(20),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the related title extraction against stored title pages"
+    )
+    parser.add_argument(
+        "--limit", type=int, default=1000, help="Most recent title pages to check"
+    )
+    args = parser.parse_args()
+
+    with Session(engine) as session:
+        print(json.dumps(check_stored_contexts(session, args.limit), indent=2))
@@ -0,0 +1,336 @@
+"""
+Opt-in request profiling (see the README) and an always-on event-loop lag monitor.
+Both profilers see every thread, but cProfile's timings get mixed up when threads
+run at the same time, so `sample` suits concurrent work better.
+"""
+
+import os
+import sys
+import time
+import hmac
+import uuid
+import asyncio
+import marshal
+import cProfile
+import pstats
+import threading
+import traceback
+from typing import Any, Optional, Annotated
+from pathlib import Path
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+
+import app_logger
+from fastapi import Depends, Header, HTTPException
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse
+
+THIS_DIR = Path(__file__).parent
+
+formatter = app_logger.CustomJSONFormatter("%(asctime)s")
+logger = app_logger.get_logger(
+    __name__, formatter, fileout=(THIS_DIR / "logs" / f"{Path(__file__).stem}.log")
+)
+
+# Profiling endpoints and headers are ignored unless this is set
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")
+
+# How often the sampling profiler snapshots every thread's stack
+PROFILE_SAMPLE_INTERVAL_SECONDS = float(
+    os.getenv("PROFILE_SAMPLE_INTERVAL_SECONDS", 0.005)
+)
+
+# How many finished profiles are kept for download (oldest are dropped first)
+PROFILE_MAX_STORED = int(os.getenv("PROFILE_MAX_STORED", 20))
+
+# The event loop counts as stalled when a callback holds it for longer than this
+LOOP_LAG_THRESHOLD_SECONDS = float(os.getenv("LOOP_LAG_THRESHOLD_SECONDS", 0.25))
+LOOP_LAG_CHECK_SECONDS = float(os.getenv("LOOP_LAG_CHECK_SECONDS", 0.05))
+
+# Frames of the stalled stack included in the log message
+LOOP_LAG_STACK_DEPTH = 8
+
+PROFILERS = ("cprofile", "sample")
+
+
+def format_frame(frame) -> str:
+    return f"{Path(frame.f_code.co_filename).name}:{frame.f_code.co_qualname}"
+
+
+# Threads whose stack only has frames from these files are idle pool threads
+# waiting for work, and aren't counted
+IDLE_THREAD_FILES = {"threading.py", "queue.py", "thread.py", "_asyncio.py"}
+
+
+class StackSampler:
+    """Samples the stacks of every thread on an interval, counting collapsed stacks."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sample, name="stack-sampler", daemon=True
+        )
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self._thread.ident:
+                    continue
+                stack = []
+                idle = True
+                while frame is not None:
+                    stack.append(format_frame(frame))
+                    idle = idle and stack[-1].split(":")[0] in IDLE_THREAD_FILES
+                    frame = frame.f_back
+                if stack and not idle:
+                    stack.append(names.get(thread_id, str(thread_id)))
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> bytes:
+        self._stopped.set()
+        self._thread.join()
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+        ).encode()
+
+
+class CProfileCapture:
+    # Only one deterministic profiler can be active per interpreter
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+
+    def start(self) -> bool:
+        if not self._lock.acquire(blocking=False):
+            return False
+        self.profiler.enable()
+        return True
+
+    def stop(self) -> bytes:
+        self.profiler.disable()
+        self._lock.release()
+        # The same format `pstats.Stats.dump_stats` writes
+        return marshal.dumps(pstats.Stats(self.profiler).stats)
+
+
+@dataclass
+class Profile:
+    id: str
+    kind: str
+    path: str
+    started_at: float
+    duration_seconds: Optional[float] = None
+    data: Optional[bytes] = field(default=None, repr=False)
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "path": self.path,
+            "started_at": self.started_at,
+            "duration_seconds": self.duration_seconds,
+            "ready": self.data is not None,
+            "bytes": len(self.data) if self.data is not None else None,
+        }
+
+
+class ProfileStore:
+    def __init__(self, maxsize: int = PROFILE_MAX_STORED):
+        self.maxsize = maxsize
+        self._profiles: OrderedDict[str, Profile] = OrderedDict()
+
+    def add(self, profile: Profile):
+        self._profiles[profile.id] = profile
+        while len(self._profiles) > self.maxsize:
+            self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[Profile]:
+        return self._profiles.get(profile_id)
+
+    def list(self) -> list[dict[str, Any]]:
+        return [profile.summary() for profile in reversed(self._profiles.values())]
+
+
+profile_store = ProfileStore()
+
+
+def is_admin(token: Optional[str]) -> bool:
+    return bool(PROFILE_ADMIN_TOKEN) and hmac.compare_digest(
+        token or "", PROFILE_ADMIN_TOKEN
+    )
+
+
+def require_admin(x_admin_token: Annotated[str | None, Header()] = None):
+    if not PROFILE_ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+AdminDep = Depends(require_admin)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware rather than `@app.middleware("http")`, so the profile spans
+    the whole response, including every chunk of a streaming body.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not PROFILE_ADMIN_TOKEN:
+            return await self.app(scope, receive, send)
+
+        headers = Headers(scope=scope)
+        kind = headers.get("x-profile")
+        if kind is None or not is_admin(headers.get("x-admin-token")):
+            return await self.app(scope, receive, send)
+
+        if kind not in PROFILERS:
+            response = PlainTextResponse(
+                f"X-Profile must be one of {', '.join(PROFILERS)}", status_code=400
+            )
+            return await response(scope, receive, send)
+
+        if kind == "cprofile":
+            profiler = CProfileCapture()
+            if not profiler.start():
+                response = PlainTextResponse(
+                    "Another cProfile capture is running", status_code=409
+                )
+                return await response(scope, receive, send)
+        else:
+            profiler = StackSampler(PROFILE_SAMPLE_INTERVAL_SECONDS)
+            profiler.start()
+
+        profile = Profile(
+            id=uuid.uuid4().hex, kind=kind, path=scope["path"], started_at=time.time()
+        )
+        profile_store.add(profile)
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-profile-id", profile.id.encode()),
+                ]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profile.data = profiler.stop()
+            profile.duration_seconds = time.perf_counter() - start
+            logger.info(
+                f"Captured {kind} profile {profile.id} of {profile.path} "
+                f"({profile.duration_seconds:.2f}s, {len(profile.data)} bytes)"
+            )
+
+
+class LoopLagMonitor:
+    """
+    Detects event loop stalls, i.e. a callback that runs for too long without
+    yielding.
+
+    A heartbeat coroutine records when the loop last got to run it. A watchdog
+    thread notices when that timestamp falls behind and captures the task and
+    stack hogging the loop while the stall is still in progress. The heartbeat
+    logs the full stall duration once it gets to run again. The monitor costs
+    one wakeup per LOOP_LAG_CHECK_SECONDS on each side.
+    """
+
+    def __init__(
+        self,
+        threshold: float = LOOP_LAG_THRESHOLD_SECONDS,
+        interval: float = LOOP_LAG_CHECK_SECONDS,
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.max_lag_seconds = 0.0
+        self.last_stall: Optional[dict[str, Any]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self._culprit: Optional[dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopped = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        """Must be called from the event loop being monitored."""
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.create_task(self._beat(), name="loop-lag-heartbeat")
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-lag-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = now - self._last_beat - self.interval
+            self._last_beat = now
+            self.max_lag_seconds = max(self.max_lag_seconds, lag)
+
+            if lag > self.threshold:
+                self.stalls += 1
+                culprit, self._culprit = self._culprit, None
+                self.last_stall = {
+                    "lag_seconds": lag,
+                    "at": time.time(),
+                    **(culprit or {}),
+                }
+                if culprit:
+                    logger.warning(
+                        f"Event loop stalled for {lag * 1000:.0f} ms in task "
+                        f"{culprit['task']} ({culprit['coroutine']}):\n"
+                        + "".join(culprit["stack"])
+                    )
+                else:
+                    logger.warning(f"Event loop stalled for {lag * 1000:.0f} ms")
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            behind = time.monotonic() - self._last_beat - self.interval
+            if behind > self.threshold and self._culprit is None:
+                self._culprit = self._describe_running()
+
+    def _describe_running(self) -> dict[str, Any]:
+        task = asyncio.current_task(self._loop)
+        frame = sys._current_frames().get(self._thread_id)
+        return {
+            "task": task.get_name() if task else None,
+            "coroutine": task.get_coro().__qualname__ if task else None,
+            "stack": traceback.format_stack(frame)[-LOOP_LAG_STACK_DEPTH:]
+            if frame
+            else [],
+        }
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "threshold_seconds": self.threshold,
+            "stalls": self.stalls,
+            "max_lag_seconds": self.max_lag_seconds,
+            "last_stall": {k: v for k, v in self.last_stall.items() if k != "stack"}
+            if self.last_stall
+            else None,
+        }
@@ -0,0 +1,99 @@
+from typing import Any
+
+from sqlmodel import Session
+from sqlalchemy import text
+
+# Queries shorter than this have too few trigrams to match on, so they only match
+# title prefixes
+SEARCH_MIN_TRIGRAM_QUERY = 3
+
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+# How many prefix matches, and how many trigram matches, a trigram search ranks
+SEARCH_CANDIDATES = 200
+
+_SELECT = """
+    SELECT
+        titles.id,
+        titles.netflix_id,
+        titles.title,
+        titles.content_type,
+        titles.release_year,
+        titles.runtime,
+        ratings.rating AS google_users_rating,
+        {score} AS score
+    FROM titles
+    LEFT JOIN ratings
+        ON ratings.netflix_id = titles.netflix_id AND ratings.vendor = 'Google users'
+"""
+
+# Served in order straight off the lower(title) text_pattern_ops index, which only
+# sorts by its own operators (hence `USING ~<~`), otherwise every match gets sorted
+PREFIX_SEARCH = text(
+    _SELECT.format(score="1.0")
+    + """
+    WHERE lower(titles.title) LIKE :prefix
+    ORDER BY lower(titles.title) USING ~<~
+    LIMIT :limit
+    """
+)
+
+# `<%` (the query's trigrams are mostly found within some word of the title) is
+# answered by the GIN index and combined with the prefix match. Only the first
+# prefix matches and the closest trigram matches are joined with ratings and
+# ranked: prefix matches first, then closer matches, then better rated titles
+TRIGRAM_SEARCH = text(
+    """
+    WITH candidates AS (
+        (
+            SELECT id
+            FROM titles
+            WHERE lower(title) LIKE :prefix
+            ORDER BY lower(title) USING ~<~
+            LIMIT :candidates
+        )
+        UNION
+        (
+            SELECT id
+            FROM titles
+            WHERE :q <% title
+            ORDER BY :q <<-> title
+            LIMIT :candidates
+        )
+    )
+    """
+    + _SELECT.format(
+        score="(lower(titles.title) LIKE :prefix)::int"
+        " + word_similarity(:q, titles.title)"
+    )
+    + """
+    JOIN candidates ON candidates.id = titles.id
+    ORDER BY score DESC, google_users_rating DESC NULLS LAST, titles.title
+    LIMIT :limit
+    """
+)
+
+
+def normalize_query(q: str) -> str:
+    return " ".join(q.lower().split())
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_titles(session: Session, q: str, limit: int) -> list[dict[str, Any]]:
+    """Title search ranked by prefix match, then trigram word similarity, then rating."""
+    q = normalize_query(q)
+    prefix = escape_like(q) + "%"
+    if len(q) < SEARCH_MIN_TRIGRAM_QUERY:
+        statement = PREFIX_SEARCH.bindparams(prefix=prefix, limit=limit)
+    else:
+        statement = TRIGRAM_SEARCH.bindparams(
+            q=q,
+            prefix=prefix,
+            limit=limit,
+            candidates=max(SEARCH_CANDIDATES, limit),
+        )
+    return [dict(row._mapping) for row in session.exec(statement)]
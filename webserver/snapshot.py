@@ -0,0 +1,145 @@
+import gzip
+import time
+import hashlib
+import threading
+from typing import Callable, Optional
+from dataclasses import dataclass
+
+# brotli and zstd are optional (`uv sync --extra compression`); gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+IDENTITY = "identity"
+
+# In order of preference when the client accepts several equally
+ENCODERS: dict[str, Callable[[bytes], bytes]] = {}
+if brotli is not None:
+    ENCODERS["br"] = lambda body: brotli.compress(body, quality=9)
+if zstandard is not None:
+    ENCODERS["zstd"] = lambda body: zstandard.ZstdCompressor(level=10).compress(body)
+ENCODERS["gzip"] = lambda body: gzip.compress(body, compresslevel=9, mtime=0)
+
+
+def parse_accept_encoding(header: str) -> dict[str, float]:
+    accepted = {}
+    for part in header.split(","):
+        coding, *params = part.strip().split(";")
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    return accepted
+
+
+@dataclass(frozen=True)
+class EncodedSnapshot:
+    """One serialized payload, pre-encoded in every supported content coding."""
+
+    etag: str
+    built_at: float
+    bodies: dict[str, bytes]
+
+    @classmethod
+    def encode(cls, body: bytes) -> "EncodedSnapshot":
+        bodies = {IDENTITY: body}
+        for coding, encoder in ENCODERS.items():
+            bodies[coding] = encoder(body)
+        return cls(
+            etag=f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"',
+            built_at=time.monotonic(),
+            bodies=bodies,
+        )
+
+    def etag_for(self, coding: str) -> str:
+        """A strong validator has to differ per content coding, so the coding is appended."""
+        if coding == IDENTITY:
+            return self.etag
+        return f'{self.etag[:-1]}-{coding}"'
+
+    def negotiate(self, accept_encoding: Optional[str]) -> str:
+        """Picks the smallest body the client accepts, falling back to identity."""
+        accepted = parse_accept_encoding(accept_encoding or "")
+        wildcard = accepted.get("*", 0.0)
+        candidates = [
+            coding for coding in ENCODERS if accepted.get(coding, wildcard) > 0
+        ]
+        if not candidates:
+            return IDENTITY
+        best = max(accepted.get(coding, wildcard) for coding in candidates)
+        return min(
+            (coding for coding in candidates if accepted.get(coding, wildcard) == best),
+            key=lambda coding: len(self.bodies[coding]),
+        )
+
+
+class SnapshotCache:
+    """
+    Holds the latest `EncodedSnapshot` produced by `build`, rebuilding it once
+    it's been marked stale or is older than `max_age` seconds.
+
+    While one thread rebuilds, everyone else keeps being served the previous
+    snapshot rather than queueing up behind the rebuild.
+    """
+
+    def __init__(self, build: Callable[[], bytes], max_age: float):
+        self.build = build
+        self.max_age = max_age
+        self._snapshot: Optional[EncodedSnapshot] = None
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def mark_stale(self):
+        self._stale = True
+
+    def _is_fresh(self) -> bool:
+        return (
+            self._snapshot is not None
+            and not self._stale
+            and time.monotonic() - self._snapshot.built_at < self.max_age
+        )
+
+    def get(self) -> EncodedSnapshot:
+        if self._is_fresh():
+            return self._snapshot
+
+        # Only block on the rebuild if there's nothing to serve in the meantime
+        if not self._lock.acquire(blocking=self._snapshot is None):
+            return self._snapshot
+
+        try:
+            if not self._is_fresh():
+                # Cleared up front so that changes made during the build aren't lost
+                self._stale = False
+                try:
+                    self._snapshot = EncodedSnapshot.encode(self.build())
+                except Exception:
+                    self._stale = True
+                    raise
+            return self._snapshot
+        finally:
+            self._lock.release()
+
+    def stats(self) -> dict[str, Optional[int | float]]:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {"age_seconds": None}
+        return {
+            "age_seconds": time.monotonic() - snapshot.built_at,
+            **{
+                f"{coding}_bytes": len(body) for coding, body in snapshot.bodies.items()
+            },
+        }
@@ -0,0 +1,185 @@
+import time
+import asyncio
+from typing import Any, Callable, Iterable, Optional, Awaitable, AsyncIterator
+from pathlib import Path
+from dataclasses import dataclass
+
+import app_logger
+
+THIS_DIR = Path(__file__).parent
+
+formatter = app_logger.CustomJSONFormatter("%(asctime)s")
+logger = app_logger.get_logger(
+    __name__, formatter, fileout=(THIS_DIR / "logs" / f"{Path(__file__).stem}.log")
+)
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    processed: int = 0
+    failed: int = 0
+    busy_seconds: float = 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "processed": self.processed,
+            "failed": self.failed,
+            "busy_seconds": self.busy_seconds,
+            "avg_seconds": self.busy_seconds / self.processed
+            if self.processed
+            else None,
+        }
+
+
+# Totals per stage name across every pipeline run by this process
+stage_totals: dict[str, StageStats] = {}
+active_pipelines: set["StagedPipeline"] = set()
+
+
+class Stage:
+    """
+    One step of a `StagedPipeline`: `concurrency` workers applying `fn` to items
+    taken from a queue holding at most `capacity` of them.
+
+    `fn` may return None to drop an item (e.g. nothing left to do for it). When
+    `fn` raises, `on_error(item, exception)` gives the item's final output, which
+    skips any later stages; without it (or if it returns None) the item is dropped.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[Any], Awaitable[Any]],
+        concurrency: int = 1,
+        capacity: int = 10,
+        on_error: Optional[Callable[[Any, Exception], Any]] = None,
+    ):
+        self.name = name
+        self.fn = fn
+        self.concurrency = concurrency
+        self.capacity = capacity
+        self.on_error = on_error
+        self.stats = StageStats()
+
+
+class StagedPipeline:
+    """
+    Runs items through a chain of stages connected by bounded queues. A full
+    queue blocks the stage feeding it, so the number of items in flight is
+    bounded by the stages' capacity and concurrency rather than by the input size.
+    """
+
+    def __init__(self, stages: list[Stage], output_capacity: int = 10):
+        self.stages = stages
+        self.output_capacity = output_capacity
+        self._queues: list[asyncio.Queue] = []
+        self._output: Optional[asyncio.Queue] = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def _feed(self, items: Iterable[Any], queue: asyncio.Queue):
+        for item in items:
+            await queue.put(item)
+        for _ in range(self.stages[0].concurrency):
+            await queue.put(_DONE)
+
+    async def _work(
+        self,
+        stage: Stage,
+        inbox: asyncio.Queue,
+        outbox: asyncio.Queue,
+        remaining_workers: list[int],
+        next_concurrency: int,
+    ):
+        totals = stage_totals.setdefault(stage.name, StageStats())
+        while (item := await inbox.get()) is not _DONE:
+            start = time.perf_counter()
+            try:
+                result = await stage.fn(item)
+            except Exception as e:
+                stage.stats.failed += 1
+                totals.failed += 1
+                logger.exception(f"Stage {stage.name} failed on {item!r}: {e}")
+                if stage.on_error is not None:
+                    failed = stage.on_error(item, e)
+                    if failed is not None:
+                        await self._output.put(failed)
+                continue
+            finally:
+                elapsed = time.perf_counter() - start
+                stage.stats.busy_seconds += elapsed
+                totals.busy_seconds += elapsed
+
+            stage.stats.processed += 1
+            totals.processed += 1
+            if result is not None:
+                await outbox.put(result)
+
+        # The last worker out tells every worker of the next stage to finish up
+        remaining_workers[0] -= 1
+        if remaining_workers[0] == 0:
+            for _ in range(next_concurrency):
+                await outbox.put(_DONE)
+
+    async def run(self, items: Iterable[Any]) -> AsyncIterator[Any]:
+        """Yields the output of the last stage, in completion order."""
+        self._queues = [asyncio.Queue(maxsize=stage.capacity) for stage in self.stages]
+        output = self._output = asyncio.Queue(maxsize=self.output_capacity)
+        outboxes = self._queues[1:] + [output]
+        next_concurrencies = [stage.concurrency for stage in self.stages[1:]] + [1]
+
+        self._tasks = [asyncio.create_task(self._feed(items, self._queues[0]))]
+        for stage, inbox, outbox, next_concurrency in zip(
+            self.stages, self._queues, outboxes, next_concurrencies
+        ):
+            remaining_workers = [stage.concurrency]
+            self._tasks.extend(
+                asyncio.create_task(
+                    self._work(
+                        stage, inbox, outbox, remaining_workers, next_concurrency
+                    ),
+                    name=f"{stage.name}-{i}",
+                )
+                for i in range(stage.concurrency)
+            )
+
+        active_pipelines.add(self)
+        try:
+            while (result := await output.get()) is not _DONE:
+                yield result
+        finally:
+            active_pipelines.discard(self)
+            self.cancel()
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {
+            stage.name: {
+                **stage.stats.as_dict(),
+                "concurrency": stage.concurrency,
+                "queued": queue.qsize(),
+                "capacity": stage.capacity,
+            }
+            for stage, queue in zip(self.stages, self._queues)
+        }
+
+
+def pipeline_metrics() -> dict[str, Any]:
+    return {
+        "active_pipelines": len(active_pipelines),
+        "stages": {
+            name: {
+                **totals.as_dict(),
+                "queued": sum(
+                    pipeline.stats().get(name, {}).get("queued", 0)
+                    for pipeline in list(active_pipelines)
+                ),
+            }
+            for name, totals in stage_totals.items()
+        },
+    }
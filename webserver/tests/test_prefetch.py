@@ -0,0 +1,37 @@
+import json
+from pathlib import Path
+
+from prefetch import parse_title_id, related_title_ids
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+
+def load_react_context():
+    return json.loads((FIXTURES_DIR / "react_context.json").read_text())
+
+
+def test_related_title_ids_reads_related_sections_only():
+    # The title itself (hero), its seasons and artwork IDs aren't related titles
+    assert related_title_ids(load_react_context()) == [
+        80117470,
+        80057281,
+        81040344,
+        70264888,
+    ]
+
+
+def test_related_title_ids_limit():
+    assert related_title_ids(load_react_context(), limit=2) == [80117470, 80057281]
+
+
+def test_related_title_ids_without_related_sections():
+    assert related_title_ids([]) == []
+    assert related_title_ids(load_react_context()[:2]) == []
+
+
+def test_parse_title_id():
+    assert parse_title_id(80117470) == 80117470
+    assert parse_title_id("Video:80117470") == 80117470
+    assert parse_title_id("80117470") == 80117470
+    assert parse_title_id("AAAABQ2") is None
+    assert parse_title_id(True) is None
@@ -0,0 +1,215 @@
+"""
+Background re-crawl worker, run as `python worker.py --processes 2 --batch-size 10`.
+Rate limits are per process, so N processes behind one IP make N times the requests.
+"""
+
+import os
+import asyncio
+import argparse
+import multiprocessing
+from pathlib import Path
+
+import app_logger
+from common import (
+    NetflixSessionHandler,
+    BrightDataSessionHandler,
+    configure_logger,
+)
+from budget import SerpBudget, next_day, day_cap_reached
+from database import engine
+from pipeline import RecordBuffer, download_title_and_lookup_ratings
+from crawl_queue import (
+    claim_due,
+    mark_failed,
+    mark_crawled,
+    mark_deferred,
+    enqueue_known_titles,
+)
+from prefetch import (
+    enqueue_related,
+    mark_prefetched,
+    related_title_ids,
+    prefetch_allowance,
+)
+from fastapi import BackgroundTasks
+from sqlmodel import Session
+
+THIS_DIR = Path(__file__).parent
+
+formatter = app_logger.CustomJSONFormatter("%(asctime)s")
+logger = app_logger.get_logger(
+    __name__, formatter, fileout=(THIS_DIR / "logs" / f"{Path(__file__).stem}.log")
+)
+configure_logger(logger)
+
+
+async def crawl_batch(
+    batch_size: int,
+    nflx_session_handler: NetflixSessionHandler,
+    brd_session_handler: BrightDataSessionHandler,
+    prefetch: bool = False,
+) -> int:
+    with Session(engine) as session:
+        # Claiming would only fetch title pages whose SERP requests get blocked
+        if await asyncio.to_thread(day_cap_reached, session):
+            logger.info("Daily SERP cap reached, not claiming any titles")
+            return 0
+        entries = await asyncio.to_thread(claim_due, session, batch_size, prefetch)
+
+    if not entries:
+        return 0
+
+    logger.info(
+        f"Claimed {len(entries)} {'prefetch ' if prefetch else ''}titles: "
+        f"{[e.netflix_id for e in entries]}"
+    )
+    background_tasks = BackgroundTasks()
+    # Only the daily cap applies to background refreshes
+    budget = SerpBudget(per_job_cap=None)
+    results = await asyncio.gather(
+        *[
+            download_title_and_lookup_ratings(
+                entry.netflix_id,
+                nflx_session_handler,
+                brd_session_handler,
+                background_tasks,
+                budget,
+            )
+            for entry in entries
+        ],
+        return_exceptions=True,
+    )
+
+    records = RecordBuffer()
+    crawled = []
+    serp_blocked = []
+    with Session(engine) as session:
+        for entry, result in zip(entries, results):
+            if isinstance(result, BaseException):
+                logger.exception(result)
+                await asyncio.to_thread(mark_failed, session, entry, result)
+                continue
+            if not result["react_context"]:
+                # Timed out or unparseable: retried with backoff, and nothing is stored
+                error = RuntimeError(f"No title data for {entry.netflix_id}")
+                await asyncio.to_thread(mark_failed, session, entry, error)
+                continue
+            records.add(result, entry.country)
+            if result["serp_blocked"]:
+                # Its ratings still need refreshing once the budget allows
+                serp_blocked.append(entry)
+            else:
+                crawled.append(entry)
+
+        await asyncio.to_thread(records.flush, session)
+        if crawled:
+            await asyncio.to_thread(mark_crawled, session, crawled)
+        if serp_blocked:
+            await asyncio.to_thread(
+                mark_deferred,
+                session,
+                serp_blocked,
+                next_day(),
+                "SERP budget exhausted",
+            )
+
+        if prefetch and crawled:
+            await asyncio.to_thread(mark_prefetched, session, crawled)
+            # Prefetched titles lead on to their own related titles, one level deeper
+            crawled_ids = {entry.id for entry in crawled}
+            for entry, result in zip(entries, results):
+                if entry.id in crawled_ids:
+                    await asyncio.to_thread(
+                        enqueue_related,
+                        session,
+                        related_title_ids(result["react_context"]),
+                        entry.country,
+                        entry.prefetch_depth + 1,
+                    )
+
+    await background_tasks()
+    logger.info(f"SERP spend for batch: {budget.report()}")
+    return len(entries)
+
+
+async def run(batch_size: int, poll_interval: float, seed_interval: float):
+    nflx_session_handler = NetflixSessionHandler()
+    brd_session_handler = BrightDataSessionHandler()
+    loop = asyncio.get_running_loop()
+    last_seeded = None
+
+    try:
+        while True:
+            if last_seeded is None or loop.time() - last_seeded > seed_interval:
+                with Session(engine) as session:
+                    seeded = await asyncio.to_thread(enqueue_known_titles, session)
+                logger.info(f"Seeded crawl queue with {seeded} titles")
+                last_seeded = loop.time()
+
+            try:
+                crawled = await crawl_batch(
+                    batch_size, nflx_session_handler, brd_session_handler
+                )
+                # Prefetching only runs once no refresh work is due and no job is
+                # running (see `prefetch_allowance`)
+                if not crawled:
+                    with Session(engine) as session:
+                        allowance = await asyncio.to_thread(prefetch_allowance, session)
+                    if allowance:
+                        crawled = await crawl_batch(
+                            min(batch_size, allowance),
+                            nflx_session_handler,
+                            brd_session_handler,
+                            prefetch=True,
+                        )
+            except Exception as e:
+                logger.exception(e)
+                crawled = 0
+
+            if not crawled:
+                await asyncio.sleep(poll_interval)
+    finally:
+        await nflx_session_handler.close()
+        await brd_session_handler.close()
+
+
+def main(args):
+    logger.info(f"Starting crawl worker (pid {os.getpid()})")
+    asyncio.run(run(args.batch_size, args.poll_interval, args.seed_interval))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Refresh stale ratings from the crawl queue"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=1, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=10, help="Titles claimed per round trip"
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=30,
+        help="Seconds to wait when nothing is due",
+    )
+    parser.add_argument(
+        "--seed-interval",
+        type=float,
+        default=3600,
+        help="Seconds between re-seeding the queue from the availability table",
+    )
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        main(args)
+    else:
+        processes = [
+            multiprocessing.Process(target=main, args=(args,))
+            for _ in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()